@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+"""
+Archive of the raw API responses a run used, so that datasets can be rebuilt without going back to the API.
+
+A FamilySearchSourcer given a ResponseArchive opened for capture (mode 'a') writes every persona, sources and
+matches response it gets into the archive. The same archive opened for replay (mode 'r') can then stand in for the
+API entirely, e.g. after census_columns.json or the extractor changes (see get_sources.replay_records).
+
+An archive is a directory of shard files and an index. Responses are zlib-compressed one at a time and appended to
+the current shard; each one gets a line in index.jsonl saying where to find it. Nothing is ever rewritten: every
+capture session starts a new shard, and the index line is only written once the response is in its shard, so an
+archive stays readable even if a capture is interrupted.
+"""
+
+import json
+import os
+import threading
+import zlib
+
+import cache
+
+
+INDEX_FILE = 'index.jsonl'
+SHARD_NAME = 'shard-{:05d}.z'
+# A new shard is started once the current one reaches this many bytes
+SHARD_BYTES = 256*1024**2
+# Only responses with these status codes are archived
+ARCHIVABLE = cache.CACHEABLE
+
+CAPTURE = 'a'
+REPLAY = 'r'
+
+
+class ResponseArchive(object):
+    """An append-only archive of API responses. Safe to share between threads (but not processes).
+
+    path (str): the directory to keep the archive in
+    mode (str): 'a' to capture responses into the archive (creating it if needed), or 'r' to replay from it
+    shard_bytes (int): the size at which to start a new shard
+    level (int): zlib compression level
+    """
+
+    def __init__(self, path, mode=REPLAY, shard_bytes=SHARD_BYTES, level=6):
+        if mode not in (CAPTURE, REPLAY):
+            raise ValueError(f"mode must be 'a' or 'r', not {mode!r}")
+        if mode == REPLAY and not os.path.isfile(os.path.join(path, INDEX_FILE)):
+            raise FileNotFoundError(f'No response archive at {path}')
+        self.path = path
+        self.mode = mode
+        self.shard_bytes = shard_bytes
+        self.level = level
+        self.lock = threading.Lock()
+        self.entries = {}  # (endpoint, ident) -> (shard, offset, length, status)
+        self.aliases = {}  # (endpoint, ident) -> the ident whose response also covers this one
+        self.order = []  # (endpoint, ident) in the order they were first archived
+        self.fds = {}
+        os.makedirs(path, exist_ok=True)
+        self._load_index()
+        self.shard = None
+        self.shard_fh = None
+        self.index_fh = None
+        if mode == CAPTURE:
+            self.index_fh = open(os.path.join(path, INDEX_FILE), 'a')
+
+    @property
+    def replaying(self):
+        return self.mode == REPLAY
+
+    @property
+    def capturing(self):
+        return self.mode == CAPTURE
+
+    def _load_index(self):
+        index = os.path.join(self.path, INDEX_FILE)
+        if not os.path.isfile(index):
+            return
+        with open(index, 'r') as fh:
+            for line in fh:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # A line cut short by an interrupted capture
+                    continue
+                self._index(entry)
+
+    def _index(self, entry):
+        key = (entry[0], entry[1])
+        if key not in self.entries and key not in self.aliases:
+            self.order.append(key)
+        if entry[2] == 'alias':
+            self.aliases.setdefault(key, entry[3])
+        else:
+            self.entries[key] = tuple(entry[2:])
+
+    def _write_index(self, entry):
+        self.index_fh.write(json.dumps(entry) + '\n')
+        self.index_fh.flush()
+        self._index(entry)
+
+    def _next_shard(self):
+        if self.shard_fh is not None:
+            self.shard_fh.close()
+        shards = [e[0] for e in self.entries.values()] + ([self.shard] if self.shard is not None else [])
+        self.shard = max(shards, default=-1) + 1
+        while os.path.exists(os.path.join(self.path, SHARD_NAME.format(self.shard))):
+            self.shard += 1
+        self.shard_fh = open(os.path.join(self.path, SHARD_NAME.format(self.shard)), 'ab')
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def idents(self, endpoint):
+        """Returns the identifiers archived from endpoint, in the order they were archived"""
+        return [ident for e, ident in self.order if e == endpoint and (e, ident) in self.entries]
+
+    def put(self, endpoint, ident, response):
+        """Archives response (a requests.models.Response) as the response for ident from endpoint.
+        Does nothing if a response for ident from endpoint is already archived.
+        """
+        if not self.capturing or response.status_code not in ARCHIVABLE:
+            return
+        key = (endpoint, str(ident))
+        body = zlib.compress(response.content, self.level) if response.content else b''
+        with self.lock:
+            if key in self.entries:
+                return
+            if self.shard_fh is None or self.shard_fh.tell() >= self.shard_bytes:
+                self._next_shard()
+            offset = self.shard_fh.tell()
+            self.shard_fh.write(body)
+            self.shard_fh.flush()
+            self._write_index([endpoint, str(ident), self.shard, offset, len(body), response.status_code])
+
+    def put_aliases(self, endpoint, ident, others):
+        """Records that the response for ident from endpoint also covers the identifiers others
+        (e.g. the other persons on a census record)
+        """
+        if not self.capturing:
+            return
+        with self.lock:
+            for other in others:
+                key = (endpoint, str(other))
+                if key not in self.entries and key not in self.aliases:
+                    self._write_index([endpoint, str(other), 'alias', str(ident)])
+
+    def alias_of(self, endpoint, ident):
+        """Returns the identifier whose archived response also covers ident, if there's no response for ident itself"""
+        key = (endpoint, str(ident))
+        if key in self.entries:
+            return None
+        return self.aliases.get(key)
+
+    def _read(self, shard, offset, length):
+        with self.lock:
+            fd = self.fds.get(shard)
+            if fd is None:
+                fd = self.fds[shard] = os.open(os.path.join(self.path, SHARD_NAME.format(shard)), os.O_RDONLY)
+        return os.pread(fd, length, offset)
+
+    def get(self, endpoint, ident, url=None):
+        """Returns the archived response for ident from endpoint as a requests.models.Response,
+        or None if there isn't one
+        """
+        entry = self.entries.get((endpoint, str(ident)))
+        if entry is None:
+            return None
+        shard, offset, length, status = entry
+        body = self._read(shard, offset, length)
+        return cache.make_response(status, zlib.decompress(body) if body else b'', url)
+
+    def close(self):
+        with self.lock:
+            for fh in (self.shard_fh, self.index_fh):
+                if fh is not None:
+                    fh.close()
+            self.shard_fh = self.index_fh = None
+            for fd in self.fds.values():
+                os.close(fd)
+            self.fds = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
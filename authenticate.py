@@ -6,10 +6,15 @@ Created on Fri May 31 14:49:43 2019
 """
 
 
-import requests
 import socket
 import os
 import json
+import threading
+import time
+
+import metrics
+import ratelimit
+import session
 
 try:
     local_dir = os.path.join(os.path.dirname(__file__))
@@ -20,6 +25,15 @@ APP_KEY = os.path.join(local_dir, 'application_key.txt')
 # The auth key file can be blank to start with. This will be
 # looked up if the one provided is not valid.
 AUTH_KEY = os.path.join(local_dir, 'authentication_key.txt')
+# JSON list of auth keys to spread requests over (see KeyPool)
+AUTH_KEYS = os.path.join(local_dir, 'authentication_keys.json')
+# Whether credentials may be asked for at the terminal when a new auth key is needed. If False, they must be in
+# the FAMILYSEARCH_USERNAME and FAMILYSEARCH_PASSWORD environment variables.
+INTERACTIVE = True
+# FamilySearch access tokens expire this many seconds after they are issued...
+TOKEN_LIFETIME = 24*60*60
+# ...or after going unused for this many seconds
+IDLE_LIFETIME = 60*60
 
 
 def get_ip():
@@ -36,12 +50,27 @@ def get_ip():
     return ip
 
 
-def get_new_auth_key():
-    with open(APP_KEY, 'r') as fh:
-        app_key = fh.read()
+def get_credentials():
+    """Returns the (username, password) to get a new auth key with, from the FAMILYSEARCH_USERNAME and
+    FAMILYSEARCH_PASSWORD environment variables if they are set, otherwise by asking the user (if INTERACTIVE)
+    """
+    username = os.environ.get('FAMILYSEARCH_USERNAME')
+    password = os.environ.get('FAMILYSEARCH_PASSWORD')
+    if username and password:
+        return username, password
+    if not INTERACTIVE:
+        raise RuntimeError('A new authentication key is needed, but FAMILYSEARCH_USERNAME and FAMILYSEARCH_PASSWORD '
+                           'are not set')
     # Ask for credentials from user
     username = input('FamilySearch Username: ')
     password = input('FamilySearch Password: ')
+    return username, password
+
+
+def get_new_auth_key():
+    with open(APP_KEY, 'r') as fh:
+        app_key = fh.read()
+    username, password = get_credentials()
     # Build request
     data = {
         'client_id': app_key,
@@ -51,9 +80,10 @@ def get_new_auth_key():
         'username': username,
         'password': password
     }
-    response = requests.post('https://ident.familysearch.org/cis-web/oauth2/v3/token',
-                             data=data,
-                             headers={'Content-Type': 'application/x-www-form-urlencoded'})
+    metrics.inc('auth_new_keys_total')
+    response = session.post(session.TOKEN_URL,
+                            data=data,
+                            headers={'Content-Type': 'application/x-www-form-urlencoded'})
     if response.status_code != 200:
         print('Invalid request for access token!')
         return
@@ -64,22 +94,166 @@ def get_new_auth_key():
     return token
 
 
+def check_auth_key(auth_key):
+    """Sends a test request with auth_key. Returns the status code: 200 if the key is valid, 401 if not"""
+    metrics.inc('auth_checks_total')
+    test = session.get(session.API_ROOT + '/platform/tree/persons',
+                       params={'pids': 'LHKL-JLF'},  # Just a random test ID
+                       headers=session.auth_headers(auth_key))
+    return test.status_code
+
+
 def read_auth_key():
     """Gets auth key either from saved value or gets new key if
     old one is no longer valid
+    (Sends a test request every time. To avoid that, use get_token_manager().get() instead.)
     """
     with open(AUTH_KEY, 'r') as fh:
         auth_key = fh.read()
     # Send a test request to check if you need a new key
-    test = requests.get('http://api.familysearch.org/platform/tree/persons',
-                        params={'pids': 'LHKL-JLF'},  # Just a random test ID
-                        headers={'Authorization': 'Bearer {}'.format(auth_key),
-                                 'Accept': 'application/json'})
-    if test.status_code == 200:
+    status = check_auth_key(auth_key)
+    if status == 200:
         return auth_key
     # Get a new key if test request didn't work
-    elif test.status_code == 401:  # Unauthorized error
+    elif status == 401:  # Unauthorized error
         print('New authentication key needed')
         return get_new_auth_key()
     else:
-        print('Unexpected error: HTTP response on test is', test.status_code)
+        print('Unexpected error: HTTP response on test is', status)
+
+
+class TokenManager(object):
+    """Keeps the access token in memory, so that it doesn't need to be read and tested for every request.
+
+    The token from AUTH_KEY is trusted without a test request: a 401 response says soon enough if it has expired.
+    A test request is only sent if the token has gone unused for long enough that it may have expired.
+    When a token is rejected, call invalidate() with it. Only the first caller to do so gets a new token;
+    any others wait for that and then get the same new token. Safe to share between threads.
+
+    lifetime (float): seconds a token lasts after it is issued. Tokens older than this are replaced without a test.
+    idle_lifetime (float): seconds a token lasts without being used. Tokens idle for longer are tested before use.
+    """
+
+    def __init__(self, lifetime=TOKEN_LIFETIME, idle_lifetime=IDLE_LIFETIME):
+        self.lifetime = lifetime
+        self.idle_lifetime = idle_lifetime
+        self.token = None
+        self.expires = 0.
+        self.last_used = 0.
+        self.lock = threading.Lock()
+
+    def _load(self):
+        """Reads the saved token, which is as old as the file it is in"""
+        try:
+            with open(AUTH_KEY, 'r') as fh:
+                self.token = fh.read().strip() or None
+            self.expires = os.path.getmtime(AUTH_KEY) + self.lifetime
+        except FileNotFoundError:
+            self.token = None
+
+    def _refresh(self):
+        metrics.inc('auth_refreshes_total')
+        token = get_new_auth_key()
+        if not token:
+            raise RuntimeError('Could not get a new authentication key')
+        self.token = token
+        self.expires = time.time() + self.lifetime
+
+    def get(self):
+        """Returns a token to send requests with, loading or replacing it first if needed"""
+        now = time.time()
+        if self.token is not None and now < self.expires and now - self.last_used < self.idle_lifetime:
+            self.last_used = now
+            return self.token
+        with self.lock:
+            if self.token is None:
+                self._load()
+            elif self.last_used and now - self.last_used >= self.idle_lifetime and now < self.expires:
+                if check_auth_key(self.token) == 401:
+                    self.token = None
+            if self.token is None or time.time() >= self.expires:
+                self._refresh()
+            self.last_used = time.time()
+            return self.token
+
+    def invalidate(self, token):
+        """Replaces token, which the API has rejected, and returns the new one.
+        If token has already been replaced (by another thread), just returns its replacement.
+        """
+        with self.lock:
+            if token == self.token or self.token is None:
+                print('New authentication key needed')
+                self._refresh()
+            self.last_used = time.time()
+            return self.token
+
+
+_token_manager = TokenManager()
+
+
+def get_token_manager():
+    """Returns the shared TokenManager"""
+    return _token_manager
+
+
+class KeyPool(object):
+    """A pool of auth keys that requests can be spread over, so that one key being throttled doesn't hold up a run.
+
+    acquire() hands out keys in turn, skipping any that the shared rate limiter has paused after a 429. A 429 for a
+    request sent with a key from the pool only pauses that key, whatever the limiter's pause_scope.
+    Keys that turn out to have expired are dropped from the pool and (if replace_expired) replaced with a new key.
+    Safe to share between threads.
+
+    keys (list, optional): the keys to use. If not given, they are read from keys_file.
+    keys_file (str): a JSON file containing a list of keys. Updated when expired keys are replaced.
+    replace_expired (bool): whether to ask for a new key (see get_new_auth_key) when one expires
+    """
+
+    def __init__(self, keys=None, keys_file=AUTH_KEYS, replace_expired=True):
+        self.keys_file = keys_file
+        if keys is None:
+            with open(keys_file, 'r') as fh:
+                keys = json.load(fh)
+        self.keys = [k for k in keys if k]
+        self.replace_expired = replace_expired
+        self.turn = 0
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.keys)
+
+    def acquire(self):
+        """Returns the next key that isn't paused for throttling, waiting for one to come free if all are"""
+        limiter = ratelimit.get_limiter()
+        while True:
+            with self.lock:
+                if not self.keys:
+                    self._add_new_key()
+                waits = []
+                for i in range(len(self.keys)):
+                    key = self.keys[(self.turn + i) % len(self.keys)]
+                    wait = limiter.paused_for(session.limiter_key(key))
+                    if wait <= 0:
+                        self.turn = (self.turn + i + 1) % len(self.keys)
+                        return key
+                    waits.append(wait)
+            time.sleep(min(waits))
+
+    def expire(self, key):
+        """Takes key, which the API has rejected as expired, out of the pool"""
+        with self.lock:
+            if key not in self.keys:
+                return  # Another thread already dealt with it
+            self.keys.remove(key)
+            metrics.inc('auth_expired_keys_total')
+            if self.replace_expired:
+                self._add_new_key()
+
+    def _add_new_key(self):
+        key = get_new_auth_key()
+        if not key:
+            raise RuntimeError('Could not get a new authentication key')
+        self.keys.append(key)
+        if self.keys_file is not None:
+            with open(self.keys_file, 'w') as fh:
+                json.dump(self.keys, fh)
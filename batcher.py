@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+"""
+Coalescing of single-item lookups into batched requests.
+
+Some endpoints (like ~/platform/tree/persons?pids=...) take many identifiers at once. A Batcher collects the lookups
+made by many threads within a short window and sends them together, up to the most the endpoint takes per request,
+then hands each caller its own part of the response. Lookups of an identifier that is already waiting to be sent
+share the same request.
+"""
+
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+
+
+# The most PIDs sent to ~/platform/tree/persons in one request
+BATCH_SIZE = 50
+# Seconds a lookup waits for others to batch with before it is sent anyway
+WINDOW = 0.02
+
+
+class Batcher(object):
+    """Sends lookups in batches. submit() can be called from many threads at once.
+
+    send (function): takes a list of identifiers and returns a dict of identifier -> result. Identifiers missing
+        from the dict get a result of None.
+    batch_size (int): the most identifiers to send at once
+    window (float): seconds to wait for a batch to fill up before sending it anyway
+    workers (int): the most batches to have in flight at once
+    """
+
+    def __init__(self, send, batch_size=BATCH_SIZE, window=WINDOW, workers=4):
+        self.send = send
+        self.batch_size = batch_size
+        self.window = window
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.pending = {}  # identifier -> Futures of the lookups waiting for it
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.closed = False
+        self.batches = 0
+        self.lookups = 0
+        self.flusher = threading.Thread(target=self._flush_periodically, daemon=True)
+        self.flusher.start()
+
+    def submit(self, ident):
+        """Queues a lookup of ident. Returns a Future for its result."""
+        future = Future()
+        with self.lock:
+            if self.closed:
+                raise RuntimeError('Batcher is closed')
+            self.lookups += 1
+            self.pending.setdefault(ident, []).append(future)
+            if len(self.pending) >= self.batch_size:
+                self._dispatch()
+            else:
+                self.wakeup.set()
+        return future
+
+    def get(self, ident):
+        """Looks up ident (batched with any other lookups made around the same time) and waits for the result"""
+        return self.submit(ident).result()
+
+    def _dispatch(self):
+        """Sends the pending lookups, batch_size at a time. Must be called with self.lock held."""
+        while self.pending:
+            batch = {}
+            for ident in list(self.pending)[:self.batch_size]:
+                batch[ident] = self.pending.pop(ident)
+            self.batches += 1
+            self.executor.submit(self._send, batch)
+
+    def _send(self, batch):
+        try:
+            results = self.send(list(batch))
+        except BaseException as e:
+            for futures in batch.values():
+                for f in futures:
+                    f.set_exception(e)
+            return
+        for ident, futures in batch.items():
+            for f in futures:
+                f.set_result(results.get(ident))
+
+    def _flush_periodically(self):
+        while not self.closed:
+            self.wakeup.wait()
+            self.wakeup.clear()
+            time.sleep(self.window)
+            with self.lock:
+                self._dispatch()
+
+    def close(self):
+        """Sends whatever is still pending and waits for all batches to be done"""
+        with self.lock:
+            self._dispatch()
+            self.closed = True
+            self.wakeup.set()
+        self.executor.shutdown(wait=True)
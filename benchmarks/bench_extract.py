@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark of extract_fields against the recursive iterate it replaces, on synthetic census records.
+
+Also checks that both give the same output for every fixture. Run from anywhere with
+    python benchmarks/bench_extract.py
+"""
+
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import get_sources  # noqa: E402
+from fixtures import make_persona  # noqa: E402
+
+
+HOUSEHOLD_SIZES = (1, 6, 15, 40)
+FIXTURES_PER_SIZE = 20
+
+
+def iterate_as_lists(persona):
+    fields, count = get_sources.iterate(persona)
+    return {k: v.split(';') for k, v in fields.items()}, count
+
+
+def main():
+    print('{:>10} {:>12} {:>12} {:>8}'.format('household', 'iterate', 'extract', 'speedup'))
+    for size in HOUSEHOLD_SIZES:
+        personas = [make_persona(household_size=size, seed=i, principal=i % size)[0]
+                    for i in range(FIXTURES_PER_SIZE)]
+        for persona in personas:
+            assert iterate_as_lists(persona) == get_sources.extract_fields(persona), 'Outputs differ'
+            # Key order matters too, since it sets the column order of the DataFrame
+            assert list(iterate_as_lists(persona)[0]) == list(get_sources.extract_fields(persona)[0])
+        number = max(1, 200 // size)
+        old = min(timeit.repeat(lambda: [get_sources.iterate(p) for p in personas], number=number, repeat=3))
+        new = min(timeit.repeat(lambda: [get_sources.extract_fields(p) for p in personas], number=number, repeat=3))
+        per_record = 1e6/(number*len(personas))
+        print('{:>10} {:>10.1f}us {:>10.1f}us {:>7.2f}x'.format(size, old*per_record, new*per_record, old/new))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+"""
+End-to-end throughput benchmark against the local mock API (benchmarks/mock_server.py).
+
+Runs FamilySearchSourcer.get_records_for_pids and FamilySearchFind.get_fsids_for_df in each of their execution
+modes against the same mock, and reports for each mode the records (or queries) per second, the p50/p99 latency of
+the requests sent, the 429s received, and the time spent waiting (summed over threads) in pauses for throttling
+(Retry-After) and in pacing by the rate limiter's token buckets.
+Run from anywhere with
+    python benchmarks/bench_throughput.py [--pids 100] [--latency 0.02] [--quota 40] [--p429 0.01]
+No real credentials are used: the mock hands out its own access tokens.
+"""
+
+import argparse
+import contextlib
+import os
+import sys
+import tempfile
+import time
+import warnings
+
+import numpy as np
+import pandas as pd
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import authenticate  # noqa: E402
+import find  # noqa: E402
+import get_sources  # noqa: E402
+import metrics  # noqa: E402
+import ratelimit  # noqa: E402
+import session  # noqa: E402
+from mock_server import MockFamilySearch  # noqa: E402
+
+
+RECORD_MODES = [
+    ('serial', dict(workers=1)),
+    ('threads=8', dict(workers=8)),
+    ('threads=32', dict(workers=32)),
+    ('threads=8, parse processes=2', dict(workers=8, parse_processes=2)),
+]
+FIND_MODES = [
+    ('serial', dict(workers=1), 1),
+    ('threads=8', dict(workers=8), 1),
+    ('threads=8, 4 keys', dict(workers=8), 4),
+]
+
+
+class Run(object):
+    """Collects the latency of every request sent through the shared session while it is active"""
+
+    def __init__(self, workers, rate):
+        session.configure(max(workers, session.POOL_SIZE))
+        ratelimit.configure(rate=rate)
+        self.latencies = []
+        session.get_session().hooks['response'].append(self.hook)
+        # The metrics registry is shared by all runs, so only the increase over the run counts
+        self.waits_before = self.waits()
+
+    @staticmethod
+    def waits():
+        """Seconds waited so far in throttling pauses and in pacing (see ratelimit.RateLimiter)"""
+        registry = metrics.get_metrics()
+        return (registry.value('ratelimit_wait_seconds', reason='retry_after'),
+                registry.value('ratelimit_wait_seconds', reason='rate'))
+
+    def hook(self, response, *args, **kwargs):
+        self.latencies.append(response.elapsed.total_seconds())
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.elapsed = time.perf_counter() - self.start
+
+    def report(self, name, done, unit):
+        limiter = ratelimit.get_limiter()
+        p50, p99 = np.percentile(self.latencies, [50, 99])*1000 if self.latencies else (np.nan, np.nan)
+        throttled, pacing = (after - before for after, before in zip(self.waits(), self.waits_before))
+        print('{:<30} {:>8.1f} {:<8} {:>8.1f}ms {:>8.1f}ms {:>6} {:>9.1f}s {:>9.1f}s'.format(
+            name, done/self.elapsed, unit + '/s', p50, p99, limiter.throttles, throttled, pacing))
+
+
+def quiet():
+    """Silences the progress messages printed for each PID"""
+    return contextlib.redirect_stdout(open(os.devnull, 'w'))
+
+
+def header(title):
+    print()
+    print(title)
+    print('{:<30} {:>17} {:>10} {:>10} {:>6} {:>10} {:>10}'.format('mode', 'throughput', 'p50', 'p99', '429s',
+                                                                 'throttled', 'pacing'))
+
+
+def bench_records(mock, pids, rate):
+    header(f'get_records_for_pids, {len(pids)} PIDs')
+    for name, kwargs in RECORD_MODES:
+        with Run(kwargs['workers'], rate) as run:
+            before = mock.served('personas', 200)
+            with get_sources.FamilySearchSourcer(**kwargs) as fss, quiet():
+                fss.get_records_for_pids(pids, get_sources.CENSUS_PTTRN)
+        run.report(name, mock.served('personas', 200) - before, 'records')
+
+
+def bench_find(mock, n, rate):
+    header(f'get_fsids_for_df, {n} rows')
+    r = np.random.RandomState(0)
+    df = pd.DataFrame({
+        'name': ['Person {}'.format(i) for i in range(n)],
+        'birthDate': r.randint(1800, 1900, n).astype(str),
+        'birthPlace': r.choice(['Utah', 'Ohio', 'Denmark'], n),
+    })
+    for name, kwargs, keys in FIND_MODES:
+        with Run(kwargs['workers'], rate) as run:
+            if keys > 1:
+                pool = authenticate.KeyPool([mock.issue_token() for _ in range(keys)], keys_file=None,
+                                            replace_expired=False)
+                fsf = find.FamilySearchFind(key_pool=pool)
+            else:
+                fsf = find.FamilySearchFind()
+            with quiet():
+                fsf.get_fsids_for_df(df, columndict=None, verbose=False, **kwargs)
+        run.report(name, n, 'queries')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='End-to-end throughput benchmark against the mock API')
+    parser.add_argument('--pids', type=int, default=100, help='the number of PIDs (and find queries) to run')
+    parser.add_argument('--latency', type=float, default=0.02, help='seconds the mock takes to answer')
+    parser.add_argument('--jitter', type=float, default=0.01)
+    parser.add_argument('--quota', type=float, default=40., help='requests per second the mock allows each token')
+    parser.add_argument('--rate', type=float, default=30., help='requests per second the rate limiter starts at')
+    parser.add_argument('--p429', type=float, default=0., help='probability of an injected 429')
+    parser.add_argument('--p204', type=float, default=0., help='probability of an injected 204')
+    args = parser.parse_args()
+    warnings.simplefilter('ignore')
+    with MockFamilySearch(latency=args.latency, jitter=args.jitter, quota=args.quota,
+                          errors={429: args.p429, 204: args.p204}) as mock:
+        session.set_api_root(mock.url)
+        with tempfile.TemporaryDirectory() as tmp:
+            authenticate.AUTH_KEY = os.path.join(tmp, 'authentication_key.txt')
+            with open(authenticate.AUTH_KEY, 'w') as fh:
+                fh.write(mock.issue_token())
+            bench_records(mock, ['P{:06d}'.format(i) for i in range(args.pids)], args.rate)
+            bench_find(mock, args.pids, args.rate)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+"""
+Synthetic FamilySearch API payloads for benchmarks.
+
+The payloads follow the shape of real GEDCOM-X responses from the personas, sources and matches endpoints closely
+enough to exercise the same code paths: labelled field values nested a few levels deep in each person, names, facts
+and record-level fields, with a household of several persons per census record.
+"""
+
+import random
+
+
+ARK_ROOT = 'https://familysearch.org/ark:/61903/1:1:'
+
+# Labels found on each person of a census record, with functions making up a value for them
+PERSON_LABELS = {
+    'PR_NAME_GN': lambda r: r.choice(['John', 'Mary', 'William', 'Sarah', 'James Henry', 'Anna; Marie']),
+    'PR_NAME_SURN': lambda r: r.choice(['Smith', 'Jensen', 'Brown', 'Olsen', 'Miller']),
+    'PR_SEX_CODE': lambda r: r.choice(['Male', 'Female']),
+    'PR_AGE': lambda r: str(r.randint(0, 90)),
+    'PR_MARITAL_STATUS': lambda r: r.choice(['Single', 'Married', 'Widowed']),
+    'PR_BIR_PLACE': lambda r: r.choice(['Utah', 'Denmark', 'England', 'Ohio', 'New York']),
+    'PR_RACE_OR_COLOR': lambda r: 'White',
+    'PR_RELATIONSHIP_TO_HEAD': lambda r: r.choice(['Head', 'Wife', 'Son', 'Daughter', 'Boarder']),
+    'PR_FTHR_BIR_PLACE': lambda r: r.choice(['Utah', 'Denmark', 'England']),
+    'PR_MTHR_BIR_PLACE': lambda r: r.choice(['Utah', 'Denmark', 'England']),
+    'PR_FLAG_CAN_READ': lambda r: r.choice(['Yes', 'No']),
+    'PR_FLAG_CAN_WRITE': lambda r: r.choice(['Yes', 'No']),
+    'PR_OCCUPATION': lambda r: r.choice(['Farmer', 'Laborer', 'Keeping House', 'At School']),
+    'PR_IMM_YEAR': lambda r: str(r.randint(1850, 1900)),
+}
+# Labels found once per census record
+RECORD_LABELS = {
+    'EVENT_YEAR': lambda r: str(r.choice(range(1850, 1950, 10))),
+    'EVENT_PLACE': lambda r: r.choice(['Salt Lake, Utah, United States', 'Cook, Illinois, United States']),
+    'SHEET_NUMBER': lambda r: str(r.randint(1, 40)),
+    'LINE_NUMBER': lambda r: str(r.randint(1, 50)),
+    'FILM_NUMBER': lambda r: str(r.randint(1000000, 2000000)),
+    'DIGITAL_FOLDER_NUMBER': lambda r: str(r.randint(4000000, 5000000)),
+    'IMAGE_NUMBER': lambda r: str(r.randint(1, 900)),
+}
+
+
+def make_arkid(r):
+    chars = 'BCDFGHJKLMNPQRSTVWXYZ0123456789'
+    return '{}-{}'.format(''.join(r.choice(chars) for _ in range(4)), ''.join(r.choice(chars) for _ in range(3)))
+
+
+def labelled_field(r, label, value):
+    return {
+        'type': 'http://familysearch.org/types/fields/' + label,
+        'values': [
+            {'type': 'http://gedcomx.org/Original', 'labelId': label, 'text': value},
+            {'type': 'http://gedcomx.org/Interpreted', 'labelId': label + '_STD', 'text': value.upper()}
+            if r.random() < 0.3 else {'type': 'http://gedcomx.org/Original', 'resource': '#x'},
+        ]
+    }
+
+
+def make_person(r, person_id, arkid):
+    values = {label: f(r) for label, f in PERSON_LABELS.items()}
+    return {
+        'id': person_id,
+        'identifiers': {'http://gedcomx.org/Persistent': [ARK_ROOT + arkid]},
+        'principal': person_id == 'p1',
+        'gender': {
+            'type': 'http://gedcomx.org/' + values['PR_SEX_CODE'],
+            'fields': [labelled_field(r, 'PR_SEX_CODE', values.pop('PR_SEX_CODE'))],
+        },
+        'names': [{
+            'nameForms': [{
+                'fullText': '{} {}'.format(values['PR_NAME_GN'], values['PR_NAME_SURN']),
+                'parts': [
+                    {'type': 'http://gedcomx.org/Given', 'value': values['PR_NAME_GN'],
+                     'fields': [labelled_field(r, 'PR_NAME_GN', values.pop('PR_NAME_GN'))]},
+                    {'type': 'http://gedcomx.org/Surname', 'value': values['PR_NAME_SURN'],
+                     'fields': [labelled_field(r, 'PR_NAME_SURN', values.pop('PR_NAME_SURN'))]},
+                ],
+            }],
+        }],
+        'facts': [{
+            'type': 'http://gedcomx.org/Birth',
+            'place': {'original': values['PR_BIR_PLACE'],
+                      'fields': [labelled_field(r, 'PR_BIR_PLACE', values.pop('PR_BIR_PLACE'))]},
+        }],
+        'fields': [labelled_field(r, label, value) for label, value in values.items()],
+    }
+
+
+def make_persona(arkid=None, household_size=6, seed=None, principal=0):
+    """A response from ~/platform/records/personas/{arkid} for a census record with household_size persons.
+
+    arkid (str, optional): the ark ID of the person of interest (made up if not given)
+    principal (int): the index of the person of interest within the household
+    Returns the response as a dict, and the ark IDs of the persons in it.
+    """
+    r = random.Random(seed if seed is not None else arkid)
+    arkids = [make_arkid(r) for _ in range(household_size)]
+    if arkid is not None:
+        arkids[principal] = arkid
+    persons = [make_person(r, f'p{i + 1}', a) for i, a in enumerate(arkids)]
+    persona = {
+        'description': '#sd_p{}'.format(principal + 1),
+        'persons': persons,
+        'relationships': [
+            {'type': 'http://gedcomx.org/Couple', 'person1': {'resource': '#p1'}, 'person2': {'resource': '#p2'}}
+        ],
+        'sourceDescriptions': [{
+            'id': 'sd_p{}'.format(principal + 1),
+            'about': ARK_ROOT + arkids[principal],
+            'titles': [{'value': 'United States Census, 1900'}],
+        }],
+        'records': [{'fields': [labelled_field(r, label, f(r)) for label, f in RECORD_LABELS.items()]}],
+    }
+    return persona, arkids
+
+
+def make_sources(pid, arkids, title='United States Census, {}'):
+    """A response from ~/platform/tree/persons/{pid}/sources with sources for arkids attached"""
+    return {
+        'persons': [{'id': pid}],
+        'sourceDescriptions': [
+            {'about': ARK_ROOT + a, 'titles': [{'value': title.format(1850 + 10*i)}]}
+            for i, a in enumerate(arkids)
+        ],
+    }
+
+
+def make_matches(arkids, scores, title='United States Census, {}'):
+    """A response from ~/platform/tree/persons/{pid}/matches for possibly matching records arkids"""
+    return {
+        'entries': [
+            {'id': ARK_ROOT + a, 'title': title.format(1850 + 10*i), 'score': s}
+            for i, (a, s) in enumerate(zip(arkids, scores))
+        ],
+    }
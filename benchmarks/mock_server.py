@@ -0,0 +1,300 @@
+# -*- coding: utf-8 -*-
+"""
+Local stand-in for the FamilySearch API, for benchmarks and for trying out changes without touching the real API.
+
+Serves the endpoints this package uses with synthetic GEDCOM-X payloads from fixtures.py:
+    POST /cis-web/oauth2/v3/token                     hands out access tokens
+    GET  /platform/tree/persons?pids=...              several tree persons at once (also used to test a token)
+    GET  /platform/tree/persons/{pid}/sources         attached sources (census records)
+    GET  /platform/tree/persons/{pid}/matches         possibly matching records, with scores
+    GET  /platform/records/personas/{arkid}           a census record for a household
+    GET  /platform/tree/matches?q=...                 tree person matches (find.FamilySearchFind)
+Payloads are generated deterministically from the PID, ark ID or query, so repeated runs see the same data.
+Responses carry an ETag, and a request whose If-None-Match matches it gets a 304 Not Modified. touch() attaches
+another record to a PID, as if its sources had been edited since the last run.
+Latency, injected errors and a per-key quota can be set to see how the client copes.
+
+Use it from Python with MockFamilySearch (see benchmarks/bench_throughput.py), or run it on its own with
+    python benchmarks/mock_server.py --port 8080 --latency 0.05
+and point the package at it with session.set_api_root('http://127.0.0.1:8080') (or FAMILYSEARCH_API_ROOT).
+"""
+
+import argparse
+import json
+import math
+import random
+import re
+import threading
+import time
+import zlib
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+from fixtures import make_arkid, make_matches, make_persona, make_sources
+
+
+# Probability of each injected error on the data endpoints (the token endpoint and token test are left alone)
+ERRORS = {204: 0., 401: 0., 429: 0., 500: 0.}
+# Seconds a client is told to wait (in Retry-After) after an injected 429
+RETRY_AFTER = 1
+
+SOURCES_PATH = re.compile(r'^/platform/tree/persons/([^/]+)/sources$')
+MATCHES_PATH = re.compile(r'^/platform/tree/persons/([^/]+)/matches$')
+PERSONAS_PATH = re.compile(r'^/platform/records/personas/([^/]+)$')
+
+
+def seeded(*parts):
+    """A random.Random seeded from parts, so that the same request always gets the same payload"""
+    return random.Random(zlib.crc32('/'.join(map(str, parts)).encode()))
+
+
+class MockFamilySearch(object):
+    """A mock FamilySearch API served from a thread in this process.
+
+    port (int): the port to listen on. 0 picks a free one (see self.url).
+    latency (float): seconds each data request takes before it is answered
+    jitter (float): up to this many extra seconds are added to the latency at random
+    errors (dict, optional): status code -> the probability of answering a data request with it instead
+        (any of 204, 401, 429 or a 5xx code). Updates the defaults in ERRORS.
+    retry_after (int): the Retry-After sent with a 429
+    quota (float, optional): requests per second allowed for each access token, beyond which requests get a 429
+    household_size (int): the number of persons on each census record
+    sources_per_pid (int): the number of census records attached to each PID
+    matches_per_pid (int): the number of possibly matching census records found for each PID
+    """
+
+    def __init__(self, port=0, latency=0., jitter=0., errors=None, retry_after=RETRY_AFTER, quota=None,
+                 household_size=6, sources_per_pid=3, matches_per_pid=2, host='127.0.0.1'):
+        self.latency = latency
+        self.jitter = jitter
+        self.errors = dict(ERRORS)
+        if errors:
+            self.errors.update(errors)
+        self.retry_after = retry_after
+        self.quota = quota
+        self.household_size = household_size
+        self.sources_per_pid = sources_per_pid
+        self.matches_per_pid = matches_per_pid
+        self.lock = threading.Lock()
+        self.random = random.Random(0)
+        self.tokens = set()
+        self.issued = 0
+        self.windows = {}  # token -> [start of the current one second window, requests in it]
+        self.counts = Counter()  # (endpoint, status) -> number of responses
+        self.touched = Counter()  # PID -> the number of records attached to it since it was generated
+        mock = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                mock.handle(self, 'GET')
+
+            def do_POST(self):
+                mock.handle(self, 'POST')
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        self.url = 'http://{}:{}'.format(host, self.server.server_address[1])
+        self.thread = None
+
+    def start(self):
+        """Starts serving in a background thread. Returns self.url"""
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self.url
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def issue_token(self):
+        with self.lock:
+            self.issued += 1
+            token = 'mock-{}'.format(self.issued)
+            self.tokens.add(token)
+        return token
+
+    def revoke(self, token):
+        """Makes token invalid, as if it had expired"""
+        with self.lock:
+            self.tokens.discard(token)
+
+    def over_quota(self, token):
+        """Counts a request against token's quota. Returns the seconds until it may send again if it is over."""
+        if self.quota is None:
+            return 0
+        now = time.monotonic()
+        with self.lock:
+            window = self.windows.setdefault(token, [now, 0])
+            if now - window[0] >= 1:
+                window[:] = [now, 0]
+            window[1] += 1
+            if window[1] > self.quota:
+                return max(1, math.ceil(1 - (now - window[0])))
+        return 0
+
+    def injected_error(self):
+        with self.lock:
+            roll = self.random.random()
+        for status, probability in self.errors.items():
+            if roll < probability:
+                return status
+            roll -= probability
+        return None
+
+    def handle(self, handler, method):
+        url = urlsplit(handler.path)
+        query = parse_qs(url.query)
+        if handler.headers.get('Content-Length'):
+            handler.rfile.read(int(handler.headers['Content-Length']))
+        if method == 'POST':
+            if url.path == '/cis-web/oauth2/v3/token':
+                return self.respond(handler, 'token', 200, {'access_token': self.issue_token(), 'token_type': 'bearer'})
+            return self.respond(handler, 'unknown', 404)
+        endpoint, payload = self.route(url.path, query)
+        if endpoint is None:
+            return self.respond(handler, 'unknown', 404)
+        authorization = handler.headers.get('Authorization', '')
+        token = authorization[len('Bearer '):] if authorization.startswith('Bearer ') else None
+        if token not in self.tokens:
+            return self.respond(handler, endpoint, 401)
+        wait = self.over_quota(token)
+        if wait:
+            return self.respond(handler, endpoint, 429, headers={'Retry-After': str(wait)})
+        delay = self.latency + (self.random.random()*self.jitter if self.jitter else 0.)
+        if delay:
+            time.sleep(delay)
+        # Lookups of persons are also how tokens are tested, so they are left alone
+        status = self.injected_error() if endpoint != 'persons' else None
+        if status == 429:
+            return self.respond(handler, endpoint, 429, headers={'Retry-After': str(self.retry_after)})
+        if status is not None:
+            return self.respond(handler, endpoint, status)
+        body = payload()
+        if body is None:
+            return self.respond(handler, endpoint, 204)
+        etag = '"{:08x}"'.format(zlib.crc32(json.dumps(body, sort_keys=True).encode()))
+        if handler.headers.get('If-None-Match') == etag:
+            return self.respond(handler, endpoint, 304, headers={'ETag': etag})
+        return self.respond(handler, endpoint, 200, body, headers={'ETag': etag})
+
+    def route(self, path, query):
+        """Returns (endpoint, function making the payload for the request), or (None, None) for an unknown path"""
+        if path == '/platform/tree/persons':
+            pids = ','.join(query.get('pids', [''])).split(',')
+            return 'persons', lambda: self.persons(pids)
+        if path == '/platform/tree/matches':
+            return 'tree_matches', lambda: self.tree_matches(query.get('q', [''])[0])
+        for endpoint, pattern, make in (('sources', SOURCES_PATH, self.sources),
+                                        ('matches', MATCHES_PATH, self.matches),
+                                        ('personas', PERSONAS_PATH, self.persona)):
+            m = pattern.match(path)
+            if m:
+                return endpoint, lambda: make(m.group(1))
+        return None, None
+
+    def record_arkids(self, pid, kind, n):
+        r = seeded(kind, pid)
+        return [make_arkid(r) for _ in range(n)]
+
+    def sources(self, pid):
+        arkids = self.record_arkids(pid, 'sources', self.sources_per_pid)
+        arkids += [make_arkid(seeded('touched', pid, i)) for i in range(self.touched[pid])]
+        return make_sources(pid, arkids)
+
+    def touch(self, pid):
+        """Attaches another census record to pid"""
+        with self.lock:
+            self.touched[pid] += 1
+
+    def matches(self, pid):
+        arkids = self.record_arkids(pid, 'matches', self.matches_per_pid)
+        if not arkids:
+            return None
+        r = seeded('scores', pid)
+        return make_matches(arkids, [round(r.uniform(1, 5), 2) for _ in arkids])
+
+    def persona(self, arkid):
+        return make_persona(arkid, self.household_size, seed=arkid)[0]
+
+    def persons(self, pids):
+        """Tree persons for pids. About 1 in 20 PIDs is not found."""
+        persons = []
+        for pid in pids:
+            r = seeded('persons', pid)
+            if not pid or r.random() < 0.05:
+                continue
+            birth = r.randint(1800, 1900)
+            persons.append({
+                'id': pid,
+                'living': False,
+                'display': {
+                    'name': '{} {}'.format(r.choice(['John', 'Mary', 'Anna']), r.choice(['Smith', 'Jensen'])),
+                    'gender': r.choice(['Male', 'Female']),
+                    'lifespan': '{}-{}'.format(birth, birth + r.randint(1, 90)),
+                    'birthDate': str(birth),
+                    'birthPlace': r.choice(['Utah', 'Denmark', 'Ohio']),
+                },
+            })
+        return {'persons': persons} if persons else None
+
+    def tree_matches(self, q):
+        r = seeded('tree', q)
+        if not q or r.random() < 0.1:
+            return None
+        scores = sorted((round(r.uniform(1, 50), 2) for _ in range(r.randint(1, 5))), reverse=True)
+        return {'entries': [{'id': make_arkid(r), 'score': s} for s in scores]}
+
+    def respond(self, handler, endpoint, status, body=None, headers=None):
+        with self.lock:
+            self.counts[(endpoint, status)] += 1
+        content = json.dumps(body).encode() if body is not None else b''
+        handler.send_response(status)
+        handler.send_header('Content-Type', 'application/json')
+        handler.send_header('Content-Length', str(len(content)))
+        for k, v in (headers or {}).items():
+            handler.send_header(k, v)
+        handler.end_headers()
+        handler.wfile.write(content)
+
+    def served(self, endpoint=None, status=None):
+        """The number of responses sent, optionally only those from endpoint and/or with status"""
+        with self.lock:
+            return sum(n for (e, s), n in self.counts.items()
+                       if (endpoint is None or e == endpoint) and (status is None or s == status))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--latency', type=float, default=0.)
+    parser.add_argument('--jitter', type=float, default=0.)
+    parser.add_argument('--quota', type=float, default=None, help='requests per second allowed for each token')
+    parser.add_argument('--retry-after', type=int, default=RETRY_AFTER)
+    for status in ERRORS:
+        parser.add_argument(f'--p{status}', type=float, default=ERRORS[status],
+                            help=f'probability of answering a data request with a {status}')
+    args = parser.parse_args()
+    errors = {status: getattr(args, f'p{status}') for status in ERRORS}
+    mock = MockFamilySearch(args.port, args.latency, args.jitter, errors, args.retry_after, args.quota)
+    print('Serving a mock FamilySearch API at', mock.url)
+    try:
+        mock.server.serve_forever()
+    except KeyboardInterrupt:
+        mock.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,173 @@
+# -*- coding: utf-8 -*-
+"""
+Persistent on-disk cache of API responses, so that re-running a pull doesn't have to fetch everything again.
+
+Responses are stored zlib-compressed in a SQLite database, keyed on the endpoint they came from plus the identifier
+(ark ID, PID or query) they were for. Each endpoint has its own time-to-live, and the least recently used responses
+are evicted once the cache grows beyond its size limit.
+"""
+
+import sqlite3
+import threading
+import time
+import zlib
+
+import requests
+
+import metrics
+import session
+
+
+CACHE_FILE = 'response_cache.sqlite'
+
+DAY = 24*60*60
+# Seconds a cached response stays valid for, by endpoint. None means forever.
+TTLS = {
+    'personas': None,  # Records almost never change
+    'sources': 7*DAY,
+    'matches': 7*DAY,
+    'tree_matches': 30*DAY,
+    'persons': 7*DAY,
+}
+# Default maximum size of the (compressed) responses stored, in bytes
+MAX_BYTES = 2*1024**3
+# Only responses with these status codes are cached
+CACHEABLE = (200, 204)
+
+READWRITE = 'readwrite'
+READONLY = 'readonly'  # Cached responses are used, but new ones aren't stored
+OFFLINE = 'offline'  # Like READONLY, but cache misses are not fetched from the network either
+MODES = (READWRITE, READONLY, OFFLINE)
+
+
+def make_response(status_code, content, url=None):
+    """Builds a requests.models.Response, for responses that don't come from the network"""
+    response = requests.models.Response()
+    response.status_code = status_code
+    response._content = content
+    response.encoding = 'utf-8'
+    response.url = url
+    return response
+
+
+class ResponseCache(object):
+    """A SQLite-backed cache of API responses. Safe to share between threads.
+
+    path (str): the file to keep the cache in
+    ttls (dict, optional): seconds a response stays valid for, by endpoint; updates the defaults in TTLS
+    max_bytes (int): the size (of compressed responses) beyond which the least recently used ones are evicted
+    mode (str): one of 'readwrite', 'readonly' (don't store new responses) or 'offline' (don't store new responses,
+        and don't fetch ones that aren't already cached)
+    level (int): zlib compression level
+    """
+
+    def __init__(self, path=CACHE_FILE, ttls=None, max_bytes=MAX_BYTES, mode=READWRITE, level=6):
+        if mode not in MODES:
+            raise ValueError(f'mode must be one of {MODES}, not {mode!r}')
+        self.path = path
+        self.ttls = dict(TTLS)
+        if ttls:
+            self.ttls.update(ttls)
+        self.max_bytes = max_bytes
+        self.mode = mode
+        self.level = level
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        with self.lock, self.conn:
+            self.conn.execute('PRAGMA journal_mode=WAL')
+            self.conn.execute(
+                'CREATE TABLE IF NOT EXISTS responses ('
+                'endpoint TEXT, ident TEXT, status INTEGER, body BLOB, size INTEGER, '
+                'stored_at REAL, accessed_at REAL, PRIMARY KEY (endpoint, ident))'
+            )
+            self.conn.execute('CREATE INDEX IF NOT EXISTS accessed ON responses (accessed_at)')
+            self.total_bytes = self.conn.execute('SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()[0]
+
+    @property
+    def offline(self):
+        return self.mode == OFFLINE
+
+    @property
+    def writable(self):
+        return self.mode == READWRITE
+
+    def get(self, endpoint, ident, url=None):
+        """Returns the cached response for ident from endpoint as a requests.models.Response,
+        or None if there isn't a valid one
+        """
+        with self.lock:
+            row = self.conn.execute('SELECT status, body, stored_at FROM responses WHERE endpoint=? AND ident=?',
+                                    (endpoint, str(ident))).fetchone()
+            if row is None:
+                return None
+            status, body, stored_at = row
+            ttl = self.ttls.get(endpoint)
+            if ttl is not None and time.time() - stored_at > ttl:
+                return None
+            if self.writable:
+                with self.conn:
+                    self.conn.execute('UPDATE responses SET accessed_at=? WHERE endpoint=? AND ident=?',
+                                      (time.time(), endpoint, str(ident)))
+        return make_response(status, zlib.decompress(body) if body else b'', url)
+
+    def put(self, endpoint, ident, response):
+        """Stores response (a requests.models.Response) as the response for ident from endpoint"""
+        if not self.writable or response.status_code not in CACHEABLE:
+            return
+        body = zlib.compress(response.content, self.level) if response.content else b''
+        now = time.time()
+        with self.lock, self.conn:
+            old = self.conn.execute('SELECT size FROM responses WHERE endpoint=? AND ident=?',
+                                    (endpoint, str(ident))).fetchone()
+            self.conn.execute('INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?)',
+                              (endpoint, str(ident), response.status_code, body, len(body), now, now))
+            self.total_bytes += len(body) - (old[0] if old else 0)
+            if self.total_bytes > self.max_bytes:
+                self._evict()
+
+    def _evict(self):
+        """Deletes the least recently used responses until the cache is back down to 90% of max_bytes"""
+        target = 0.9*self.max_bytes
+        rows = self.conn.execute('SELECT endpoint, ident, size FROM responses ORDER BY accessed_at')
+        to_delete = []
+        for endpoint, ident, size in rows:
+            if self.total_bytes <= target:
+                break
+            to_delete.append((endpoint, ident))
+            self.total_bytes -= size
+        self.conn.executemany('DELETE FROM responses WHERE endpoint=? AND ident=?', to_delete)
+
+    def clear(self, endpoint=None):
+        """Deletes all cached responses, or just the ones from endpoint"""
+        with self.lock, self.conn:
+            if endpoint is None:
+                self.conn.execute('DELETE FROM responses')
+            else:
+                self.conn.execute('DELETE FROM responses WHERE endpoint=?', (endpoint,))
+            self.total_bytes = self.conn.execute('SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()[0]
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+
+def cached_get(response_cache, endpoint, ident, url, **kwargs):
+    """Sends a GET request for url through the session module, reading through response_cache if it is not None.
+
+    endpoint (str): the name of the endpoint url belongs to (e.g. 'personas'), used with ident as the cache key
+    ident: the identifier (ark ID, PID or query) the request is for
+    Any other keyword arguments are passed on to session.get.
+    If the cache is offline, a response missing from it is treated as a 204 (no results).
+    """
+    if response_cache is None:
+        return session.get(url, **kwargs)
+    response = response_cache.get(endpoint, ident, url)
+    if response is not None:
+        metrics.inc('cache_hits_total', endpoint=endpoint)
+        return response
+    metrics.inc('cache_misses_total', endpoint=endpoint)
+    if response_cache.offline:
+        return make_response(204, b'', url)
+    response = session.get(url, **kwargs)
+    response_cache.put(endpoint, ident, response)
+    return response
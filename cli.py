@@ -0,0 +1,289 @@
+# -*- coding: utf-8 -*-
+"""
+Command-line interface to the tools in this package, for running without prompts (e.g. from a job scheduler).
+
+    python cli.py find people.csv -o pids.csv --workers 8
+    python cli.py census pids.csv -o census.csv --workers 8 --cache responses.sqlite
+    python cli.py deaths pids.csv -o deaths.csv --chunksize 1000
+    python cli.py persons pids.csv -o persons.csv
+    python cli.py condense census_uncondensed.csv -o census.csv --type census
+    python cli.py replay archive_dir -o census.csv --type census
+    python cli.py census pids.csv -o census.parquet --format parquet --partition-by year
+    python cli.py census pids.csv -o census.csv --refresh
+    python cli.py records pids.csv -o records.csv --type census --type deaths --pattern marriages='[Mm]arriage'
+    python cli.py pipeline people.csv -o census.csv --type census --min-score 20 --matches pids.csv
+
+Heavy modules (pandas and the modules using it) are only imported once a command needs them, so starting up and
+--help are fast. When a new auth key is needed, credentials are taken from the FAMILYSEARCH_USERNAME and
+FAMILYSEARCH_PASSWORD environment variables; with --no-prompt the command fails rather than asking for them.
+"""
+
+import argparse
+import os
+import sys
+from contextlib import ExitStack, redirect_stdout
+
+
+# The names of the record types in get_sources.RECORD_TYPES, listed here so that --help doesn't have to import it
+RECORD_TYPES = ['census', 'deaths']
+
+
+def record_type(name):
+    """Returns the (lookfor pattern, condense function) for a record type (see get_sources.RECORD_TYPES)"""
+    import get_sources
+    return get_sources.RECORD_TYPES[name]
+
+
+def columnar_output(args, record_type):
+    """Returns the columnar.ColumnarOutput asked for with --format, or None for CSV"""
+    if args.format == 'csv':
+        return None
+    import columnar
+    partition_by = args.partition_by or []
+    return columnar.ColumnarOutput(args.format, args.compression, partition_by,
+                                   record_type if 'record_type' in partition_by else None)
+
+
+def configure(args):
+    """Applies the options shared by all commands. Returns the response cache to use, if any."""
+    import authenticate
+    import ratelimit
+    import session
+    if args.api_root:
+        session.set_api_root(args.api_root, args.token_url)
+    if args.auth_key_file:
+        authenticate.AUTH_KEY = args.auth_key_file
+    if args.no_prompt:
+        authenticate.INTERACTIVE = False
+    # The pause scope is left alone with --keys-file: a 429 for a key from the pool only pauses that key anyway (see
+    # session.request), and the records stage of pipeline, which uses a single key, should still pause as a whole
+    if args.rate is not None:
+        ratelimit.configure(rate=args.rate)
+    if args.cache is None:
+        return None
+    import cache
+    return cache.ResponseCache(args.cache, mode=args.cache_mode)
+
+
+def run_find(args, response_cache):
+    import authenticate
+    import find
+    key_pool = authenticate.KeyPool(keys_file=args.keys_file) if args.keys_file else None
+    fsf = find.FamilySearchFind(response_cache=response_cache, key_pool=key_pool)
+    index_col = None if args.index_col < 0 else args.index_col
+    df = fsf.get_fsids_for_df(args.input, index_col=index_col, columndict=args.column_map or find.COLUMN_MAP,
+                              verbose=not args.quiet, workers=args.workers)
+    df.to_csv(args.output)
+
+
+def run_records(args, response_cache):
+    import archive
+    import get_sources
+    lookfor, condense = record_type(args.command)
+    sourcer_kwargs = {'parse_processes': args.parse_processes}
+    if args.refresh:
+        if args.chunksize or args.checkpoint or args.archive or args.format != 'csv':
+            raise SystemExit('--refresh cannot be combined with --chunksize, --checkpoint, --archive or --format')
+        import refresh
+        refresh.refresh_records_for_pids_in_csv(lookfor, args.input, args.output, condense if args.condense else None,
+                                                args.col_name, args.save_uncondensed, args.workers, response_cache,
+                                                **sourcer_kwargs)
+        return
+    with ExitStack() as stack:
+        if args.archive:
+            response_archive = archive.ResponseArchive(args.archive, archive.CAPTURE)
+            sourcer_kwargs['response_archive'] = stack.enter_context(response_archive)
+        get_sources.get_and_save_records_for_pids_in_csv(
+            lookfor, condense if args.condense else None, args.input, args.col_name, args.output,
+            args.save_uncondensed, args.workers, response_cache, args.checkpoint, args.chunksize,
+            columnar_output(args, args.command), **sourcer_kwargs)
+
+
+def run_records_by_type(args, response_cache):
+    import get_sources
+    record_types = {}
+    for name in args.type or []:
+        lookfor, condense = record_type(name)
+        record_types[name] = (lookfor, condense if args.condense else None)
+    for pattern in args.pattern or []:
+        name, sep, lookfor = pattern.partition('=')
+        if not sep or not name:
+            raise SystemExit(f'--pattern must be NAME=REGEX, not {pattern!r}')
+        record_types[name] = (lookfor, None)
+    if not record_types:
+        raise SystemExit('Give at least one --type or --pattern')
+    get_sources.get_and_save_records_by_type(
+        args.input, record_types, args.output, args.col_name, args.save_uncondensed, args.workers, response_cache,
+        args.chunksize, {name: columnar_output(args, name) for name in record_types},
+        parse_processes=args.parse_processes)
+
+
+def run_pipeline(args, response_cache):
+    import authenticate
+    import find
+    import pipeline
+    lookfor, condense = record_type(args.type)
+    key_pool = authenticate.KeyPool(keys_file=args.keys_file) if args.keys_file else None
+    index_col = None if args.index_col < 0 else args.index_col
+    matches = pipeline.find_and_save_records(
+        args.input, lookfor, args.output, condense if args.condense else None, args.min_score, args.find_workers,
+        args.workers, args.queue_size, args.chunksize, args.save_uncondensed, index_col,
+        args.column_map or find.COLUMN_MAP, response_cache, key_pool, not args.quiet,
+        columnar_output(args, args.type), parse_processes=args.parse_processes)
+    if args.matches:
+        matches.to_csv(args.matches)
+
+
+def run_persons(args, response_cache):
+    import get_sources
+    get_sources.get_persons_for_pids_in_csv(args.input, args.col_name, args.output, args.workers, response_cache)
+
+
+def run_condense(args, response_cache):
+    import pandas as pd
+    import get_sources
+    _, condense = record_type(args.type)
+    df = condense(pd.read_csv(args.input, low_memory=False))
+    if args.dedup:
+        df = get_sources.dedup(df)
+    df.to_csv(args.output, index=False)
+
+
+def run_replay(args, response_cache):
+    import get_sources
+    lookfor, condense = record_type(args.type)
+    get_sources.replay_records(args.archive, lookfor, args.output, condense if args.condense else None,
+                               args.save_uncondensed, args.pids, args.col_name, args.processes, args.chunksize,
+                               columnar_output(args, args.type))
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description='Tools for getting data from the FamilySearch API')
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument('--workers', type=int, default=1, help='the number of requests to keep in flight at once')
+    common.add_argument('--cache', help='a SQLite file to cache API responses in (see cache.ResponseCache)')
+    common.add_argument('--cache-mode', choices=['readwrite', 'readonly', 'offline'], default='readwrite')
+    common.add_argument('--rate', type=float, help='requests per second to start each auth key at')
+    common.add_argument('--api-root', help='send requests here instead of to FamilySearch (e.g. a mock server)')
+    common.add_argument('--token-url', help='with --api-root, where to get access tokens')
+    common.add_argument('--auth-key-file', help='the file to keep the access token in')
+    common.add_argument('--no-prompt', action='store_true',
+                        help="fail instead of asking for credentials if they aren't in the environment")
+    common.add_argument('--metrics', help='a file to write metrics to periodically (.prom for Prometheus, else JSON)')
+    common.add_argument('--metrics-interval', type=float, default=10., help='seconds between metrics snapshots')
+    common.add_argument('--quiet', action='store_true', help="don't print a message for each row or PID")
+    output_options = argparse.ArgumentParser(add_help=False)
+    output_options.add_argument('--format', choices=['csv', 'parquet', 'arrow'], default='csv',
+                                help='with parquet or arrow, the output is a directory of part files')
+    output_options.add_argument('--compression', default='zstd', help='the codec for parquet or arrow output')
+    output_options.add_argument('--partition-by', action='append', choices=['year', 'record_type'],
+                                help='split parquet or arrow output into directories by this column (repeatable)')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    find = commands.add_parser('find', parents=[common], help='find the PIDs of the people in a CSV')
+    find.add_argument('input', help='a CSV with a column for each piece of identifying info')
+    find.add_argument('-o', '--output', required=True)
+    find.add_argument('--index-col', type=int, default=0, help='the column holding the index (-1 for none)')
+    find.add_argument('--column-map', help='a JSON file mapping the columns to FamilySearch search parameters')
+    find.add_argument('--keys-file', help='a JSON list of auth keys to spread requests over')
+    find.set_defaults(run=run_find)
+
+    for name in RECORD_TYPES:
+        records = commands.add_parser(name, parents=[common, output_options],
+                                      help=f'get the {name} records of the PIDs in a CSV')
+        records.add_argument('input', help='a CSV with a column of PIDs')
+        records.add_argument('-o', '--output', required=True,
+                             help='the CSV (or directory, with --format) to save the (condensed) records at')
+        records.add_argument('--col-name', default='PID', help='the column holding the PIDs')
+        records.add_argument('--no-condense', dest='condense', action='store_false')
+        records.add_argument('--no-uncondensed', dest='save_uncondensed', action='store_false',
+                             help="don't also save the uncondensed records")
+        records.add_argument('--checkpoint', action='store_true', help='journal progress so a crashed run can resume')
+        records.add_argument('--chunksize', type=int, help='stream the run this many PIDs at a time')
+        records.add_argument('--parse-processes', type=int, default=0, help='parse records in this many processes')
+        records.add_argument('--archive', help='a directory to capture the raw responses in (see replay)')
+        records.add_argument('--refresh', action='store_true',
+                             help='update the output of an earlier run, only fetching PIDs whose sources changed')
+        records.set_defaults(run=run_records)
+
+    by_type = commands.add_parser('records', parents=[common, output_options],
+                                  help='get the records of several types for the PIDs in a CSV in one run')
+    by_type.add_argument('input', help='a CSV with a column of PIDs')
+    by_type.add_argument('-o', '--output', required=True,
+                         help='where to save the records, with the name of each type added (e.g. records_census.csv)')
+    by_type.add_argument('--type', action='append', choices=RECORD_TYPES,
+                         help='a record type to get (repeatable)')
+    by_type.add_argument('--pattern', action='append', metavar='NAME=REGEX',
+                         help='also get records whose descriptions match REGEX, saved uncondensed as NAME (repeatable)')
+    by_type.add_argument('--col-name', default='PID', help='the column holding the PIDs')
+    by_type.add_argument('--no-condense', dest='condense', action='store_false')
+    by_type.add_argument('--no-uncondensed', dest='save_uncondensed', action='store_false',
+                         help="don't also save the uncondensed records")
+    by_type.add_argument('--chunksize', type=int, help='stream the run this many PIDs at a time')
+    by_type.add_argument('--parse-processes', type=int, default=0, help='parse records in this many processes')
+    by_type.set_defaults(run=run_records_by_type)
+
+    pipe = commands.add_parser('pipeline', parents=[common, output_options],
+                               help='find the PIDs of the people in a CSV and get their records at the same time')
+    pipe.add_argument('input', help='a CSV with a column for each piece of identifying info')
+    pipe.add_argument('-o', '--output', required=True, help='the CSV (or directory, with --format) for the records')
+    pipe.add_argument('--type', choices=RECORD_TYPES, required=True)
+    pipe.add_argument('--matches', help='a CSV to save the matches for each person at')
+    pipe.add_argument('--min-score', type=float, help='only get the records of best matches scoring at least this')
+    pipe.add_argument('--find-workers', type=int, default=4, help='the number of match queries to keep in flight')
+    pipe.add_argument('--queue-size', type=int, default=100, help='the most matched PIDs waiting for records')
+    pipe.add_argument('--index-col', type=int, default=0, help='the column holding the index (-1 for none)')
+    pipe.add_argument('--column-map', help='a JSON file mapping the columns to FamilySearch search parameters')
+    pipe.add_argument('--keys-file', help='a JSON list of auth keys to spread match queries over')
+    pipe.add_argument('--no-condense', dest='condense', action='store_false')
+    pipe.add_argument('--no-uncondensed', dest='save_uncondensed', action='store_false')
+    pipe.add_argument('--chunksize', type=int, default=1000, help='save records this many PIDs at a time')
+    pipe.add_argument('--parse-processes', type=int, default=0, help='parse records in this many processes')
+    pipe.set_defaults(run=run_pipeline)
+
+    persons = commands.add_parser('persons', parents=[common], help='look up the PIDs in a CSV in the tree')
+    persons.add_argument('input', help='a CSV with a column of PIDs')
+    persons.add_argument('-o', '--output', required=True)
+    persons.add_argument('--col-name', default='PID', help='the column holding the PIDs')
+    persons.set_defaults(run=run_persons)
+
+    condense = commands.add_parser('condense', parents=[common], help='condense uncondensed records')
+    condense.add_argument('input')
+    condense.add_argument('-o', '--output', required=True)
+    condense.add_argument('--type', choices=RECORD_TYPES, required=True)
+    condense.add_argument('--dedup', action='store_true', help='keep only the best record of each PID and year')
+    condense.set_defaults(run=run_condense)
+
+    replay = commands.add_parser('replay', parents=[common, output_options],
+                                 help='rebuild records from a response archive offline')
+    replay.add_argument('archive', help='a directory of responses captured with --archive')
+    replay.add_argument('-o', '--output', required=True)
+    replay.add_argument('--type', choices=RECORD_TYPES, required=True)
+    replay.add_argument('--pids', help='a CSV of the PIDs to replay (defaults to every PID in the archive)')
+    replay.add_argument('--col-name', default='PID')
+    replay.add_argument('--no-condense', dest='condense', action='store_false')
+    replay.add_argument('--no-uncondensed', dest='save_uncondensed', action='store_false')
+    replay.add_argument('--processes', type=int, help='defaults to the number of CPUs')
+    replay.add_argument('--chunksize', type=int, default=1000, help='PIDs per process at a time')
+    replay.set_defaults(run=run_replay)
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    response_cache = configure(args)
+    with ExitStack() as stack:
+        if args.metrics:
+            import metrics
+            stack.enter_context(metrics.Exporter(args.metrics, args.metrics_interval))
+        if args.quiet:
+            stack.enter_context(redirect_stdout(stack.enter_context(open(os.devnull, 'w'))))
+        try:
+            args.run(args, response_cache)
+        finally:
+            if response_cache is not None:
+                response_cache.close()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,166 @@
+# -*- coding: utf-8 -*-
+"""
+Columnar (Parquet or Arrow IPC) output, as an alternative to CSV for large runs.
+
+A dataset is a directory of part files. Every write adds new part files rather than rewriting existing ones, so a
+run can append to its output chunk by chunk, and readers only need to load the columns and partitions they use.
+Condensed data is written with a schema declared by its columns file (e.g. census_columns.json): every column in
+the file, in order, with the types in COLUMN_TYPES. The schema is saved with the dataset, so appending data with
+different columns (e.g. after the columns file changes) is an error instead of silently drifting.
+Uncondensed data, whose columns depend on the records found, gets a schema inferred from each write.
+
+Needs pyarrow, which is only imported when a dataset is written or read.
+"""
+
+import json
+import os
+import shutil
+import uuid
+
+import numpy as np
+import pandas as pd
+
+
+FORMATS = ('parquet', 'arrow')
+# Default compression codec of the part files
+COMPRESSION = 'zstd'
+# The file in a dataset directory that holds its declared schema
+SCHEMA_FILE = '_schema.arrow'
+# Types of the columns that aren't strings
+COLUMN_TYPES = {
+    'year': 'int64',
+    'is_person': 'int64',
+    'score': 'float64',
+}
+
+
+def _arrow():
+    try:
+        import pyarrow
+        import pyarrow.dataset
+    except ImportError:
+        raise ImportError('Parquet/Arrow output needs pyarrow (pip install pyarrow)') from None
+    return pyarrow, pyarrow.dataset
+
+
+def schema_for_columns(columns, types=None):
+    """Returns a pyarrow schema for columns: strings, apart from those in types (which updates COLUMN_TYPES)"""
+    pa, _ = _arrow()
+    types = dict(COLUMN_TYPES, **(types or {}))
+    return pa.schema([(c, pa.type_for_alias(types.get(c, 'string'))) for c in columns])
+
+
+def schema_for(columns_file, types=None):
+    """Returns the pyarrow schema of the data condensed with columns_file (e.g. census_columns.json)"""
+    with open(columns_file, 'r') as fh:
+        return schema_for_columns(list(json.load(fh)), types)
+
+
+def uncondensed_path(path):
+    """The dataset the uncondensed data is saved at when the condensed data is saved at path"""
+    root, ext = os.path.splitext(path.rstrip('/\\'))
+    return root + '_uncondensed' + ext
+
+
+def _conform(df, schema):
+    """Converts df to a pyarrow Table with schema, adding any columns df is missing as nulls"""
+    pa, _ = _arrow()
+    data = {}
+    for field in schema:
+        column = df[field.name] if field.name in df.columns else pd.Series(np.nan, index=df.index, dtype=object)
+        if pa.types.is_string(field.type):
+            column = column.map(lambda v: None if pd.isna(v) else str(v))
+        elif pa.types.is_integer(field.type):
+            column = pd.to_numeric(column, errors='coerce').astype('Int64')
+        else:
+            column = pd.to_numeric(column, errors='coerce')
+        data[field.name] = pa.array(column, type=field.type, from_pandas=True)
+    return pa.Table.from_pydict(data, schema=schema)
+
+
+class ColumnarOutput(object):
+    """Options for writing datasets, used in place of CSV output (see get_sources.condense_and_save).
+
+    format (str): 'parquet' or 'arrow' (Arrow IPC)
+    compression (str, optional): the compression codec of the part files (e.g. 'zstd', 'snappy' or 'lz4')
+    partition_by (list, optional): columns to partition datasets by (e.g. ['year'] or ['record_type']), as
+        directories named like year=1900. Columns a dataset doesn't have are skipped.
+    record_type (str, optional): if given, written to a record_type column of every row (e.g. 'census')
+    """
+
+    def __init__(self, format='parquet', compression=COMPRESSION, partition_by=None, record_type=None):
+        if format not in FORMATS:
+            raise ValueError(f'format must be one of {FORMATS}, not {format!r}')
+        self.format = format
+        self.compression = compression
+        self.partition_by = list(partition_by or [])
+        self.record_type = record_type
+
+    def _file_format(self):
+        _, ds = _arrow()
+        if self.format == 'parquet':
+            file_format = ds.ParquetFileFormat()
+            return file_format, file_format.make_write_options(compression=self.compression)
+        file_format = ds.IpcFileFormat()
+        return file_format, file_format.make_write_options(compression=self.compression)
+
+    def _check_schema(self, path, schema):
+        """Saves schema as the declared schema of the dataset at path, or checks that it matches the saved one"""
+        pa, _ = _arrow()
+        schema_file = os.path.join(path, SCHEMA_FILE)
+        if os.path.isfile(schema_file):
+            with open(schema_file, 'rb') as fh:
+                existing = pa.ipc.read_schema(pa.py_buffer(fh.read()))
+            if not existing.equals(schema):
+                raise ValueError(f'The schema of the data does not match the schema of the dataset at {path}. '
+                                 'Write it to a new dataset instead.')
+            return
+        with open(schema_file, 'wb') as fh:
+            fh.write(schema.serialize().to_pybytes())
+
+    def write(self, df, path, schema=None, append=True):
+        """Writes df as new part files of the dataset at path
+
+        schema (pyarrow.Schema, optional): the declared schema of the dataset (see schema_for). If not given, one
+            is inferred from the columns of df (see schema_for_columns), and not checked against earlier writes.
+        append (bool): whether to add to the dataset if it already exists, or replace it
+        """
+        pa, ds = _arrow()
+        if not append and os.path.isdir(path):
+            shutil.rmtree(path)
+        os.makedirs(path, exist_ok=True)
+        if self.record_type is not None:
+            df = df.assign(record_type=self.record_type)
+            if schema is not None and 'record_type' not in schema.names:
+                schema = schema.append(pa.field('record_type', pa.string()))
+        if schema is not None:
+            self._check_schema(path, schema)
+        else:
+            schema = schema_for_columns(df.columns)
+        if not len(df):
+            return
+        table = _conform(df, schema)
+        file_format, file_options = self._file_format()
+        partition_by = [c for c in self.partition_by if c in schema.names]
+        ds.write_dataset(
+            table, path, format=file_format, file_options=file_options,
+            partitioning=partition_by or None, partitioning_flavor='hive' if partition_by else None,
+            basename_template='part-{}-{{i}}.{}'.format(uuid.uuid4().hex, self.format),
+            existing_data_behavior='overwrite_or_ignore',
+        )
+
+
+def read_dataset(path, columns=None, filter=None, format='parquet'):
+    """Reads (some of the columns and rows of) a dataset as a DataFrame. Part files with different columns (as in
+    uncondensed datasets) are lined up, with nulls for the columns a part doesn't have.
+
+    columns (list, optional): the columns to read
+    filter (pyarrow.dataset.Expression, optional): which rows to read, e.g. pyarrow.dataset.field('year') == 1900.
+        Filters on partition columns skip the other partitions entirely.
+    """
+    pa, ds = _arrow()
+    file_format = 'ipc' if format == 'arrow' else format
+    dataset = ds.dataset(path, format=file_format, partitioning='hive', exclude_invalid_files=True)
+    schema = pa.unify_schemas([f.physical_schema for f in dataset.get_fragments()] + [dataset.schema])
+    dataset = ds.dataset(path, schema=schema, format=file_format, partitioning='hive', exclude_invalid_files=True)
+    return dataset.to_table(columns=columns, filter=filter).to_pandas()
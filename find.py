@@ -7,12 +7,17 @@ Created on Sat Jun  1 09:30:10 2019
 Tools for finding FamilySearch PIDs given identifying info
 """
 
-import requests
 import pandas as pd
-import time
+import numpy as np
 import json
+import os
+import queue
+import threading
 
 import authenticate
+import cache
+import metrics
+import session
 
 """
 COLUMN_MAP file should be a json file formatted like
@@ -24,17 +29,39 @@ with the valid familysearch_search_param fields defined in the FamilySearch API
 (https://www.familysearch.org/developers/docs/api/tree/Tree_Person_Search_resource)
 
 """
-COLUMN_MAP = 'column_map.json'
-with open(COLUMN_MAP, 'r') as fh:
-    column_map = json.load(fh)
+COLUMN_MAP = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'column_map.json')
+_column_maps = {}
+
+
+def load_column_map(filename=COLUMN_MAP):
+    """Reads a COLUMN_MAP-style file. Each file is only read once."""
+    if filename not in _column_maps:
+        with open(filename, 'r') as fh:
+            _column_maps[filename] = json.load(fh)
+    return _column_maps[filename]
+
+
+def __getattr__(name):
+    # column_map used to be read when this module was imported
+    if name == 'column_map':
+        return load_column_map()
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
 
 
 class FamilySearchFind(object):
     """FamilySearchFind object is essentially a container for find-related functions with authentication integrated.
     """
     
-    def __init__(self):
-        self.key = authenticate.read_auth_key()
+    def __init__(self, response_cache=None, key_pool=None):
+        """
+        response_cache (cache.ResponseCache, optional): if provided, match queries are read through this cache
+        key_pool (authenticate.KeyPool, optional): if provided, requests are spread over the keys in this pool
+            instead of the single key from authenticate.get_token_manager(). A key that gets a 429 is paused on its
+            own (whatever the rate limiter's pause_scope), and the query is retried with the next key that isn't.
+        """
+        self.response_cache = response_cache
+        self.key_pool = key_pool
+        self.tokens = authenticate.get_token_manager()
 
     @staticmethod
     def format_params(persondict):
@@ -66,27 +93,57 @@ class FamilySearchFind(object):
             dict_['score3'] = entries[2]['score']
         return dict_
 
+    @staticmethod
+    def build_queries(df):
+        """Like format_params, but for every row of df at once: returns a Series (with the index of df) of the query
+        for each row, built from its non-missing values with vectorized string operations.
+        Runs of whitespace in values are collapsed, so values differing only in spacing give the same query.
+        """
+        queries = pd.Series('', index=df.index)
+        for col in df.columns:
+            values = df[col]
+            if values.dtype.kind == 'f' and (values.dropna() % 1 == 0).all():
+                values = values.astype('Int64')  # e.g. years read in as floats because of missing values
+            stripped = values.astype(str).str.strip()
+            words = stripped.str.replace(r'\s+', '+', regex=True).where(values.notna(), '')
+            # Quoted if it is several words, as in format_params (not if a single word contains a '+')
+            quoted = stripped.str.contains(r'\s', regex=True) & values.notna()
+            param = (col + ':' + words.where(~quoted, '"' + words + '"')).where(words != '', '')
+            separator = pd.Series('+', index=df.index).where((queries != '') & (param != ''), '')
+            queries = queries + separator + param
+        return queries
+
     def get_fsid(self, persondict):
         """Takes a dict of params (like the ones built by get_fsids_for_df),
         queries familysearch match for matches, and returns the 3 best matches
         """
-        params = self.format_params(persondict)
+        return self.get_fsid_for_query(self.format_params(persondict))
+
+    def get_fsid_for_query(self, params):
+        """Like get_fsid, but takes a query already formatted (by format_params or build_queries)"""
+        if not params:
+            return {}  # A row with nothing to search by has no matches
         # Use matches rather than search.
-        api_root = 'http://api.familysearch.org/platform/tree/matches?q='
-        response = requests.get(api_root + params,
-                                headers={'Authorization': 'Bearer {}'.format(self.key),
-                                         'Accept': 'application/json'})
-        if response.status_code == 429:
-            wait = float(response.headers['Retry-After'])*1.1
-            print('Throttled, waiting {:.1f} seconds!'.format(wait))
-            time.sleep(wait)
-            return self.get_fsid(persondict)
-        # 401 is permission error. Reauthenticate if this happens.
-        elif response.status_code == 401:
-            self.key = authenticate.read_auth_key()
-            return self.get_fsid(persondict)
-        elif response.status_code == 204:
-            print('No results for query {}'.format(persondict))
+        api_root = session.API_ROOT + '/platform/tree/matches?q='
+        while True:
+            key = self.tokens.get() if self.key_pool is None else self.key_pool.acquire()
+            # With a single key, session.get waits out throttling itself. With a pool, we move on to another key.
+            response = cache.cached_get(self.response_cache, 'tree_matches', params, api_root + params,
+                                        headers=session.auth_headers(key), retry_throttled=self.key_pool is None)
+            if response.status_code == 429:
+                metrics.inc('retries_total', endpoint='tree_matches', reason='429')
+                continue
+            # 401 is permission error. Reauthenticate if this happens.
+            if response.status_code == 401:
+                metrics.inc('retries_total', endpoint='tree_matches', reason='401')
+                if self.key_pool is None:
+                    self.tokens.invalidate(key)
+                else:
+                    self.key_pool.expire(key)
+                continue
+            break
+        if response.status_code == 204:
+            print('No results for query {}'.format(params))
             return {}
         elif response.status_code != 200:
             print('Unsuccessful request: HTTP status code is {}'.format(response.status_code))
@@ -94,33 +151,102 @@ class FamilySearchFind(object):
         best_entries = response.json()['entries'][:3]  # Best options come first
         return self.process_fs_entry(best_entries)
 
-    def get_fsids_for_df(self, df, index_col=0, columndict=column_map, verbose=True):
+    def get_fsids_for_df(self, df, index_col=0, columndict=COLUMN_MAP, verbose=True, workers=1):
         """Takes a pandas DataFrame and returns a dataframe of likely matches
         
         df: the dataframe to match for. the columns are identifier types; each row is a person
         index_col: the column of the dataframe that contains its index. set to None if there is no index
-        columndict: a dict object to convert df's column names to FamilySearch identifiers.
-            Defaults to the dict in the COLUMN_MAP file
+        columndict: a dict object (or the file name of a JSON file with one) to convert df's column names to
+            FamilySearch identifiers. Defaults to the COLUMN_MAP file
         verbose: whether or not to print updates for each entry as the API is queried.
+        workers: the number of threads to send queries from. Each idle thread takes the next query from a shared
+            queue (and a key from self.key_pool, if there is one). The output is in the same order as df regardless.
+        Rows whose queries (see build_queries) are the same apart from case are only queried once, and each gets a
+        copy of the result.
+        """
+        df = self.prepare_df(df, index_col, columndict)
+        metrics.get_metrics().set('pids_expected', len(df))
+        distinct, codes = self.distinct_queries(df)
+        rows_per_query = np.bincount(codes, minlength=len(distinct))
+        results = [None]*len(distinct)
+
+        def run(position):
+            params = distinct.iloc[position]
+            if verbose:
+                print(f'Working on {distinct.index[position]}...')
+            results[position] = self.get_fsid_for_query(params)
+            metrics.inc('pids_done_total', int(rows_per_query[position]))
+
+        if workers <= 1:
+            for position in range(len(distinct)):
+                run(position)
+        else:
+            self.run_threaded(run, len(distinct), workers)
+        return self.spread_results(results, codes, df.index)
+
+    @staticmethod
+    def prepare_df(df, index_col=0, columndict=COLUMN_MAP):
+        """Reads df (if it is a file name) and renames its columns to FamilySearch identifiers with columndict, as
+        for get_fsids_for_df
         """
-        pids = []
         if type(df) is str:  # If df is a str assume it is the filename of a csv
             try:
                 df = pd.read_csv(df, index_col=index_col)
             except UnicodeDecodeError:
                 df = pd.read_csv(df, index_col=index_col, encoding='ansi')
+        if isinstance(columndict, str):
+            columndict = load_column_map(columndict)
         if columndict:
             df = df[columndict.keys()].rename(columns=columndict)
-        for index, row in df.iterrows():
-            if verbose:
-                print(f'Working on {index}...')
-            persondict = {}
-            for col in df.columns:
-                if pd.notna(row[col]):
-                    persondict[col] = row[col]
-            pids.append(self.get_fsid(persondict))
-        return pd.DataFrame(pids, index=df.index)
-    
+        return df
+
+    def distinct_queries(self, df):
+        """Returns (distinct, codes): the distinct queries for the rows of df (see build_queries), as a Series
+        indexed by the first row with each, and the position in distinct of the query for each row.
+        Rows with the same identifying info (ignoring case and spacing) share a query.
+        """
+        queries = self.build_queries(df)
+        codes, _ = pd.factorize(queries.str.casefold())
+        distinct = queries[~pd.Series(codes).duplicated().to_numpy()]
+        metrics.get_metrics().set('queries_distinct', len(distinct))
+        return distinct, codes
+
+    @staticmethod
+    def spread_results(results, codes, index):
+        """Returns a DataFrame (with index) of the result for each row, from the results of the distinct queries"""
+        out = pd.DataFrame(results)
+        return out.take(codes).set_axis(index) if len(out.columns) else pd.DataFrame(index=index)
+
+    @staticmethod
+    def run_threaded(func, n, workers):
+        """Calls func(position) for each position in range(n) from workers threads. Each idle thread takes the next
+        position from a shared queue. The first exception raised by func (if any) is raised once all threads stop.
+        """
+        session.ensure_pool_size(workers)
+        work = queue.Queue()
+        for position in range(n):
+            work.put(position)
+        errors = []
+
+        def worker():
+            while not errors:
+                try:
+                    position = work.get_nowait()
+                except queue.Empty:
+                    return
+                try:
+                    func(position)
+                except Exception as e:
+                    errors.append(e)
+
+        threads = [threading.Thread(target=worker, daemon=True) for _ in range(workers)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if errors:
+            raise errors[0]
+
 if __name__ == '__main__':
     # This code will be run if the file is executed directly rather than imported.
     input_filename = input('Type the file path of the input file: ')
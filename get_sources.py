@@ -7,7 +7,6 @@ Created on Fri Aug  2 13:10:29 2019
 Includes tools for getting source info via FamilySearch API, particularly for getting and processing census data
 """
 
-import requests
 import re
 import pandas as pd
 import numpy as np
@@ -15,18 +14,74 @@ import time
 import warnings
 import json
 import os
+import shutil
+import threading
+from collections import deque
+from contextlib import ExitStack
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from itertools import repeat
 
+import archive
 import authenticate
+import batcher
+import cache
+import columnar
+import metrics
+import parse_pool
+import persona_index
+import retry
+import runjournal
+import session
 
 
 CENSUS_PTTRN = r'[Cc]ensus'
 DEATH_PTTRN = r'[Dd]eath'
-CENSUS_COLUMNS = 'census_columns.json'
-DEATH_RECORD_COLUMNS = 'death_record_columns.json'
+# Column files are found next to this module, whatever the working directory
+CENSUS_COLUMNS = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'census_columns.json')
+DEATH_RECORD_COLUMNS = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'death_record_columns.json')
+
+# Columns of the DataFrame from FamilySearchSourcer.get_persons_for_pids
+PERSON_COLUMNS = ['PID', 'found', 'id', 'name', 'gender', 'lifespan', 'birth_date', 'birth_place', 'living']
 
 ark_re = re.compile(r'[^:]{4}-[^:]{3}$')
 
 
+def compile_patterns(patterns):
+    """Compiles the record type patterns (a dict of record type name -> regular expression) once, so that each
+    source description can be tested against all of them without looking them up in re's cache every time
+    """
+    return {name: re.compile(pattern) for name, pattern in patterns.items()}
+
+
+def classify_attached(sources, patterns):
+    """Sorts the sources attached to a person (from get_attached_sources) into record types.
+    Returns (arkid, 1, names) for each source with an ark ID, where names are the record types (keys of the
+    patterns) its description matches. The confidence is assumed to be 1 for sources already attached.
+
+    patterns (dict): record type name -> compiled regular expression (see compile_patterns)
+    """
+    classified = []
+    for source in sources:
+        title = ' '.join(x['value'] for x in source['titles'])
+        try:
+            arkid = ark_re.search(source['about']).group()
+        except (KeyError, AttributeError):
+            continue
+        classified.append((arkid, 1, [name for name, pattern in patterns.items() if pattern.search(title)]))
+    return classified
+
+
+def classify_other(sources, patterns):
+    """Like classify_attached, but for possibly matching sources (from search_for_sources), with their scores"""
+    classified = []
+    for source in sources:
+        arkid = ark_re.search(source['id'])
+        if arkid is not None:
+            classified.append((arkid.group(), source['score'],
+                               [name for name, pattern in patterns.items() if pattern.search(source['title'])]))
+    return classified
+
+
 def log_warning(message, origin=None, load=None, log_file='log.txt'):
     """Print a warning message and save warning info to a log file.
 
@@ -104,51 +159,252 @@ def iterate(dictionary, mydict=None):
     return mydict, count
 
 
-def create_df(response, arkid):
-    """Takes a successful HTTP response from a request to the FamilySearch API for a record
-    extracts the relevant fields, and puts them together as a Pandas DataFrame.
+def find_person_index(dictionary):
+    """Returns the index in dictionary['persons'] of the person a record is about (the same count iterate returns)"""
+    try:
+        keep = dictionary['description'][4:]
+        for count in range(len(dictionary['persons'])):
+            if keep == dictionary['persons'][count]['id']:
+                break
+    except:
+        count = 0
+    return count
 
-    response (requests.models.Response): A (status 200) response to a GET query to ~/platform/records/personas/{arkid}
+
+def extract_fields(dictionary):
+    """Does the same job as iterate, but in a single non-recursive pass, and collects the values for each label in a
+    list rather than joining them into a ';'-separated string. So for a given record, the values of the dict returned
+    are the same as the values of the dict from iterate after splitting on ';'.
+
+    dictionary (dict): the JSON from the API
+    Returns the dict of label -> list of values, and the index of the person the record is about.
+    """
+    fields = {}
+    # Each stack frame is an iterator over a dict's (token, value) pairs or a list's items, along with the
+    # [label, check] state for a dict, or None for a list
+    stack = [(iter(dictionary.items()), [None, False])]
+    while stack:
+        items, state = stack[-1]
+        if state is None:
+            for x in items:
+                if isinstance(x, dict):
+                    stack.append((iter(x.items()), [None, False]))
+                    break
+            else:
+                stack.pop()
+            continue
+        for token, value in items:
+            if isinstance(value, dict):
+                stack.append((iter(value.items()), [None, False]))
+                break
+            elif isinstance(value, list):
+                stack.append((iter(value), None))
+                break
+            if token == 'labelId':
+                state[0] = value
+                state[1] = True
+            elif state[1] and token == 'text':
+                label = state[0].lower()
+                value = value.replace(';', ':')
+                if label in fields:
+                    fields[label].append(value)
+                else:
+                    fields[label] = [value]
+                state[1] = False
+        else:
+            stack.pop()
+    return fields, find_person_index(dictionary)
+
+
+def parse_record(response_dict, arkid):
+    """Extracts the relevant fields from the JSON of a record from the FamilySearch API.
+
+    response_dict (dict): the JSON from a (status 200) response to a GET query to ~/platform/records/personas/{arkid}
     arkid (str): The ark ID of the requested resource
+    Returns a tuple (fields, is_person, ark_ids), where fields is a dict of label -> list of values (as from
+    extract_fields), and is_person and ark_ids are lists with an entry for each person (row) on the record.
     """
-    # Create dictionary based on JSON response
-    response_dict = response.json()
-    source_dict, c = iterate(response_dict)
-    # Convert to Pandas DataFrame
-    for k in source_dict.keys():
-        source_dict[k] = source_dict[k].split(';')
-    df = pd.DataFrame.from_dict(source_dict, orient='index').transpose()
-    df['is_person'] = [int(i == c) for i in range(len(df))]
+    fields, c = extract_fields(response_dict)
+    length = max((len(v) for v in fields.values()), default=0)
+    is_person = [int(i == c) for i in range(length)]
     try:
         arkids = [p['identifiers']['http://gedcomx.org/Persistent'][0] for p in response_dict['persons']]
         arkids = [ark_re.search(x).group() for x in arkids]
-        assert len(arkids) == len(df)
+        assert len(arkids) == length
     except (KeyError, AssertionError, AttributeError):
-        arkids = [None]*len(df)
+        arkids = [None]*length
         try:
             arkids[c] = arkid
         except IndexError:
             pass
-    df['ark_id'] = arkids
+    return fields, is_person, arkids
+
+
+def record_to_df(record):
+    """Puts a record parsed by parse_record together as a Pandas DataFrame"""
+    fields, is_person, arkids = record
+    with metrics.timer('create_df'):
+        df = pd.DataFrame.from_dict(fields, orient='index').transpose()
+        df['is_person'] = is_person
+        df['ark_id'] = arkids
     return df
 
 
-class FamilySearchSourcer:
+def create_df(response, arkid):
+    """Takes a successful HTTP response from a request to the FamilySearch API for a record
+    extracts the relevant fields, and puts them together as a Pandas DataFrame.
+
+    response (requests.models.Response): A (status 200) response to a GET query to ~/platform/records/personas/{arkid}
+    arkid (str): The ark ID of the requested resource
+    """
+    return record_to_df(parse_record(response.json(), arkid))
+
+
+class RecordAccumulator(object):
+    """Collects the records for many PIDs into plain lists, one per column, and builds a single DataFrame out of
+    them at the end. This is much cheaper than building a DataFrame for every record and concatenating them.
+
+    The DataFrame built is the same (columns, column order and values) as concatenating the DataFrames that
+    get_records_for_pid gives for each PID added.
+    """
 
     def __init__(self):
-        self.authenticate()
-        self.retries = 0
+        self.columns = {}
+        self.length = 0
+        # Each record's rows are numbered from 0, as in the DataFrames from process_record
+        self.index = []
+        # Only the first occurrence of a column in this list counts
+        self.order = []
+
+    def _extend(self, name, values, at):
+        """Adds values to column name, starting at row at (rows before that it has no values for are NaN)"""
+        column = self.columns.setdefault(name, [])
+        if len(column) < at:
+            column.extend([np.nan]*(at - len(column)))
+        column.extend(values)
+
+    def add_pid(self, pid, records):
+        """Adds the records for pid
+
+        records (list): pairs of (record, score), where record is from parse_record, or None if it couldn't be fetched
+        """
+        if not records:
+            return
+        start = self.length
+        names = set()
+        for record, score in records:
+            names.add('score')
+            if record is None:
+                # An unavailable record has no rows, but still gives the PID's data a score column
+                self.columns.setdefault('score', [])
+                continue
+            fields, is_person, arkids = record
+            n = len(is_person)
+            for name, values in fields.items():
+                # Labels with fewer values than there are persons on the record are padded with None
+                self._extend(name, values + [None]*(n - len(values)) if len(values) < n else values, self.length)
+            self._extend('is_person', is_person, self.length)
+            self._extend('ark_id', arkids, self.length)
+            self._extend('score', [score]*n, self.length)
+            names.update(fields)
+            names.update(('is_person', 'ark_id'))
+            self.index.extend(range(n))
+            self.length += n
+        self._extend('PID', [pid]*(self.length - start), start)
+        # Within a PID columns are sorted (as with pd.concat(..., sort=True)) and followed by PID
+        self.order.extend(sorted(names))
+        self.order.append('PID')
+
+    def build(self):
+        """Returns all the records added so far as a single DataFrame"""
+        with metrics.timer('create_df'):
+            data = {}
+            for name in self.order:
+                if name not in data:
+                    column = self.columns[name]
+                    if len(column) < self.length:
+                        column.extend([np.nan]*(self.length - len(column)))
+                    data[name] = column
+            return pd.DataFrame(data, index=self.index) if data else pd.DataFrame()
+
+
+class FamilySearchSourcer:
+
+    def __init__(self, workers=1, response_cache=None, reuse_households=True, parse_processes=0,
+                 parse_batch_size=parse_pool.BATCH_SIZE, response_archive=None, index_size=persona_index.MAX_ARKIDS):
+        """
+        workers (int): the number of requests to keep in flight at once when getting records for several PIDs
+            (see iter_parsed_records_for_pids). The default of 1 runs everything serially.
+        response_cache (cache.ResponseCache, optional): if provided, API responses are read through this cache
+        reuse_households (bool): whether to keep a persona_index.PersonaIndex of the records fetched, so that a
+            record that was already fetched for another member of the same household (or is being fetched right now)
+            isn't requested again
+        index_size (int): if reuse_households, the most ark IDs to keep in the index (see persona_index.for_chunksize)
+        parse_processes (int): if not 0, records are decoded and parsed in a parse_pool.ParsePool with this many
+            processes (None for one per CPU) instead of in the threads waiting on the network. Call close() when done.
+        parse_batch_size (int): if parse_processes is not 0, the number of records sent to a process at once
+        response_archive (archive.ResponseArchive, optional): if opened for capture, every response is also written
+            to this archive. If opened for replay, responses come from it instead of the API (and response_cache).
+        """
+        self.workers = workers
+        self.response_cache = response_cache
+        self.response_archive = response_archive
+        self.persona_index = persona_index.PersonaIndex(index_size) if reuse_households else None
+        self.tokens = authenticate.get_token_manager()
+        self.parse_pool = (parse_pool.ParsePool(parse_processes, parse_batch_size)
+                           if parse_processes != 0 else None)
+        # Created the first time a person is looked up (see get_person)
+        self.person_batcher = None
+        # PID -> attached sources already fetched (e.g. by refresh.check_pid), used once instead of requesting them
+        self.known_sources = {}
+        self.lock = threading.Lock()
+        session.ensure_pool_size(workers)
+        if ((response_cache is not None and response_cache.offline) or
+                (response_archive is not None and response_archive.replaying)):
+            # Nothing will be sent to the API, so there's no need for an access token
+            self.key = None
+            self.headers = {}
+        else:
+            self.authenticate()
+
+    def close(self):
+        """Shuts down the parse pool and the person lookup batcher, if there are any"""
+        if self.parse_pool is not None:
+            self.parse_pool.close()
+        if self.person_batcher is not None:
+            self.person_batcher.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
 
     def authenticate(self):
         """Get an access token and set the headers to be used for queries to the API"""
-        self.key = authenticate.read_auth_key()
-        self.headers = {
-            'Authorization': 'Bearer {}'.format(self.key),
-            'Accept': 'application/json'
-        }
+        self.key = self.tokens.get()
+        self.headers = session.auth_headers(self.key)
+
+    def api_get(self, endpoint, ident, url, defer=False):
+        """Sends a GET request for url (see cache.cached_get), through the response archive if there is one.
+        Server errors are retried (see retry.call). If the circuit breaker for endpoint is open, waits for the breaker
+        to let requests through, or if defer is True, raises retry.CircuitOpen (for callers that can put the work
+        aside, like iter_parsed_records_by_type).
+        """
+        archived = self.response_archive
+        if archived is not None and archived.replaying:
+            response = archived.get(endpoint, ident, url)
+            # A response that wasn't archived is treated as a 204 (no results), as with an offline cache
+            return response if response is not None else cache.make_response(204, b'', url)
+        response = cache.cached_get(self.response_cache, endpoint, ident, url, headers=self.headers, defer=defer)
+        if archived is not None:
+            archived.put(endpoint, ident, response)
+        return response
 
     def process_response(self, response, func, load, null, mutator):
         """Process the response to a GET request to the API, dealing with possible errors
+        (Throttling and retrying server errors are dealt with by session.request, so 429 responses don't make it
+        here, and a 5xx response means the retries ran out.)
 
         response (requests.models.Response): The response to a GET request to the API
         func (function): the function that created the request (needed so we can retry if it didn't work the first time)
@@ -162,44 +418,113 @@ class FamilySearchSourcer:
         elif response.status_code == 204:
             to_return = null()  # no results
         elif response.status_code == 401:
-            # Reauthenticate and retry
+            # Reauthenticate and retry. Only the first thread to see the key rejected gets a new one.
+            metrics.inc('retries_total', endpoint=metrics.endpoint_for(response.url or ''), reason='401')
+            self.tokens.invalidate(session.key_of(response) or self.key)
             self.authenticate()
             to_return = func(load)
-        elif response.status_code == 429:
-            # Wait and retry
-            wait = float(response.headers['Retry-After'])*1.1
-            print('Throttled, waiting {:.1f} seconds!'.format(wait))
-            time.sleep(wait)
-            to_return = func(load)
         elif response.status_code >= 500:  # Server-side error
-            if self.retries < 3:
-                self.retries += 1
-                print(f'Server-side error ({response.status_code}). Waiting 1 minute, then retrying...')
-                time.sleep(60)
-                return func(load)  # Don't send to to_return since we don't want to reset retries.
-            else:
-                log_warning(f'Retries maxed out. Last status was {response.status_code}.', func, load)
-                to_return = null()
+            log_warning(f'Retries maxed out. Last status was {response.status_code}.', func, load)
+            to_return = null()
         else:
             log_warning(f'HTTP status code {response.status_code}', func, load)
             to_return = null()
-        self.retries = 0
         return to_return
 
-    def get_attached_sources(self, pid):
-        """Takes a PID and returns a dict describing the sources attached to that person."""
-        url = f'https://api.familysearch.org/platform/tree/persons/{pid}/sources'
-        response = requests.get(url, headers=self.headers)
+    def get_attached_sources(self, pid, defer=False):
+        """Takes a PID and returns a dict describing the sources attached to that person.
+        defer (bool): whether to raise retry.CircuitOpen if the endpoint's circuit breaker is open (see api_get)
+        """
+        known = self.known_sources.pop(pid, None)
+        if known is not None:
+            return known
+        url = f'{session.API_ROOT}/platform/tree/persons/{pid}/sources'
+        response = self.api_get('sources', pid, url, defer)
         return self.process_response(response, self.get_attached_sources, pid, list,
                                      lambda x, _: x.json()['sourceDescriptions'])
 
-    def search_for_sources(self, pid):
-        """Takes a PID and returns a dict describing possibly matching (but unattached) sources for that person."""
-        url = (f'https://api.familysearch.org/platform/tree/persons/{pid}/matches?' +
+    def get_attached_sources_if_changed(self, pid, etag=None, last_modified=None):
+        """Like get_attached_sources, but sends a conditional request with the validators (ETag and Last-Modified)
+        of the sources list from an earlier request, and always to the API (not the response cache or archive).
+        Returns (sources, etag, last_modified): the sources, or None if the API answered 304 Not Modified, and the
+        validators of the current sources list. If there is a response cache, a changed sources list is stored in it.
+        If the request fails (anything but a 200, 204 or 304, once retries and reauthenticating are done with),
+        returns (None, etag, last_modified) too, so that the caller keeps what it knew about the sources.
+        """
+        url = f'{session.API_ROOT}/platform/tree/persons/{pid}/sources'
+        headers = dict(self.headers)
+        if etag:
+            headers['If-None-Match'] = etag
+        if last_modified:
+            headers['If-Modified-Since'] = last_modified
+        response = session.get(url, headers=headers, defer=True)
+        if response.status_code == 304:
+            metrics.inc('not_modified_total', endpoint='sources')
+            return None, etag, last_modified
+        if self.response_cache is not None:
+            self.response_cache.put('sources', pid, response)
+        if response.status_code == 204:
+            return [], response.headers.get('ETag'), response.headers.get('Last-Modified')  # No sources attached
+        return self.process_response(
+            response, lambda _: self.get_attached_sources_if_changed(pid, etag, last_modified), pid,
+            lambda: (None, etag, last_modified),
+            lambda x, _: (x.json()['sourceDescriptions'], x.headers.get('ETag'), x.headers.get('Last-Modified')))
+
+    def search_for_sources(self, pid, defer=False):
+        """Takes a PID and returns a dict describing possibly matching (but unattached) sources for that person.
+        defer (bool): whether to raise retry.CircuitOpen if the endpoint's circuit breaker is open (see api_get)
+        """
+        url = (f'{session.API_ROOT}/platform/tree/persons/{pid}/matches?' +
                 'collection=https://familysearch.org/platform/collections/records')
-        response = requests.get(url, headers=self.headers)
+        response = self.api_get('matches', pid, url, defer)
         return self.process_response(response, self.search_for_sources, pid, list, lambda x, _: x.json()['entries'])
 
+    def fetch_persons(self, pids):
+        """Takes a list of PIDs (at most batcher.BATCH_SIZE) and gets them from the tree in a single request.
+        Returns a dict of PID -> the person (as a dict from the API) for each one that was found.
+        """
+        pids = list(pids)
+        url = f'{session.API_ROOT}/platform/tree/persons?pids=' + ','.join(pids)
+        response = self.api_get('persons', ','.join(pids), url)
+        return self.process_response(response, self.fetch_persons, pids, dict,
+                                     lambda x, _: {p['id']: p for p in x.json().get('persons', [])})
+
+    def get_person(self, pid):
+        """Takes a PID and returns the person from the tree (as a dict from the API), or None if it wasn't found.
+        Lookups from all threads are collected for a moment and sent together (see batcher.Batcher), so looking up
+        many PIDs at once costs one request per batcher.BATCH_SIZE PIDs rather than one per PID.
+        """
+        return self.submit_person(pid).result()
+
+    def submit_person(self, pid):
+        """Like get_person, but returns a Future for the person instead of waiting for it"""
+        if self.person_batcher is None:
+            with self.lock:
+                if self.person_batcher is None:
+                    self.person_batcher = batcher.Batcher(self.fetch_persons, workers=max(1, self.workers))
+        return self.person_batcher.submit(pid)
+
+    def get_persons_for_pids(self, pids):
+        """Looks up an iterable of PIDs in the tree, in as few requests as possible.
+        Returns a DataFrame (with PERSON_COLUMNS) with a row for each PID, in the order of pids: whether it was found,
+        the ID it was found under, and the summary the API gives of the person.
+        """
+        futures = [(pid, self.submit_person(pid)) for pid in pids]
+        rows = []
+        for pid, future in futures:
+            person = future.result()
+            if person is None:
+                rows.append({'PID': pid, 'found': False})
+                continue
+            display = person.get('display', {})
+            rows.append({
+                'PID': pid, 'found': True, 'id': person.get('id'), 'name': display.get('name'),
+                'gender': display.get('gender'), 'lifespan': display.get('lifespan'),
+                'birth_date': display.get('birthDate'), 'birth_place': display.get('birthPlace'),
+                'living': person.get('living'),
+            })
+        return pd.DataFrame(rows, columns=PERSON_COLUMNS)
+
     def check_attached_sources(self, pid, lookfor):
         """Gets ark ids for records attached to a person that have a given word/pattern in their descriptions
 
@@ -208,16 +533,14 @@ class FamilySearchSourcer:
         
         Returns pairs of arkids along with their confidence scores
         """
-        arkids = []
-        sources = self.get_attached_sources(pid)
-        for source in sources:
-            if re.search(lookfor, ' '.join(x['value'] for x in source['titles'])):
-                try:
-                    arkids.append(ark_re.search(source['about']).group())
-                except (KeyError, AttributeError):
-                    continue
+        arkids = self.attached_arkids(self.get_attached_sources(pid), lookfor)
         return list(zip(arkids, [1]*len(arkids)))  # Confidence assumed to be 1 for sources already attached
 
+    @staticmethod
+    def attached_arkids(sources, lookfor):
+        """The ark IDs of the sources (from get_attached_sources) with descriptions matching lookfor"""
+        return [arkid for arkid, _, types in classify_attached(sources, compile_patterns({None: lookfor})) if types]
+
     def check_other_sources(self, pid, lookfor):
         """Like check_attached_sources, but searches for as-yet-unattached records instead of looking at attached ones
 
@@ -226,42 +549,244 @@ class FamilySearchSourcer:
         
         Returns pairs of arkids along with their confidence scores
         """
-        arkids = []
-        scores = []
-        sources = self.search_for_sources(pid)
-        for source in sources:
-            if re.search(lookfor, source['title']):
-                arkid = ark_re.search(source['id'])
-                if arkid is not None:
-                    arkids.append(arkid.group())
-                    scores.append(source['score'])
-        return list(zip(arkids, scores))
+        classified = classify_other(self.search_for_sources(pid), compile_patterns({None: lookfor}))
+        return [(arkid, score) for arkid, score, types in classified if types]
 
     def check_all_sources(self, pid, lookfor):
         return self.check_attached_sources(pid, lookfor) + self.check_other_sources(pid, lookfor)
 
+    def check_sources_by_type(self, pid, patterns, defer=False):
+        """Like check_all_sources, but sorts the records of a person into several record types at once. The lists
+        of attached and possibly matching sources are only fetched once, however many types there are.
+
+        patterns (dict): record type name -> the regular expression (str or compiled) its descriptions match.
+            A record whose description matches several patterns counts as each of those types.
+        defer (bool): whether to raise retry.CircuitOpen if the circuit breaker of an endpoint is open (see api_get)
+        Returns a dict of record type name -> pairs of arkids along with their confidence scores
+        """
+        patterns = compile_patterns(patterns)
+        by_type = {name: [] for name in patterns}
+        for arkid, score, types in (classify_attached(self.get_attached_sources(pid, defer), patterns) +
+                                    classify_other(self.search_for_sources(pid, defer), patterns)):
+            for name in types:
+                by_type[name].append((arkid, score))
+        return by_type
+
+    def fetch_record(self, arkid, defer=False):
+        """Takes the ark ID for a record and returns the record parsed by parse_record, or None if it isn't available
+        defer (bool): whether to raise retry.CircuitOpen if the endpoint's circuit breaker is open (see api_get)
+        """
+        archived = self.response_archive
+        if archived is not None and archived.replaying:
+            # The record may only have been archived for another person in the same household
+            covered_by = archived.alias_of('personas', arkid)
+            if covered_by is not None:
+                record = self.get_record(covered_by, defer)
+                if record is None or arkid not in record[2]:
+                    return None
+                return persona_index.PersonaIndex.view(record, record[2].index(arkid))
+        url = f'{session.API_ROOT}/platform/records/personas/{arkid}'
+        response = self.api_get('personas', arkid, url, defer)
+        record = self.process_response(response, self.fetch_record, arkid, lambda: None, self.parse)
+        if record is not None and archived is not None:
+            archived.put_aliases('personas', arkid, [a for a in record[2] if a is not None and a != arkid])
+        return record
+
+    def parse(self, response, arkid):
+        """Parses a (status 200) response for the record arkid with parse_record, in the parse pool if there is one"""
+        with metrics.timer('parse'):
+            if self.parse_pool is not None:
+                return self.parse_pool.parse(response.content, arkid)
+            return parse_record(response.json(), arkid)
+
+    def get_record(self, arkid, defer=False):
+        """Like fetch_record, but reuses records already fetched in this run if possible (see persona_index)"""
+        if self.persona_index is None:
+            return self.fetch_record(arkid, defer)
+        return self.persona_index.get(arkid, lambda x: self.fetch_record(x, defer))
+
     def process_record(self, arkid, score):
         """Takes the ark ID for a record and creates a Pandas DataFrame of the data on the record."""
-        url = f'https://api.familysearch.org/platform/records/personas/{arkid}'
-        response = requests.get(url, headers=self.headers)
-        df = self.process_response(response, self.process_record, arkid, pd.DataFrame, create_df)
+        record = self.get_record(arkid)
+        df = record_to_df(record) if record is not None else pd.DataFrame()
         df['score'] = [score]*len(df)
         return df
 
+    def get_parsed_records_for_pid(self, pid, lookfor):
+        """Returns pairs of (record, score) for each record of a person with a description matching lookfor,
+        where record is from parse_record (or None if it wasn't available)
+        """
+        return self.get_parsed_records_by_type(pid, {None: lookfor})[None]
+
+    def get_parsed_records_by_type(self, pid, patterns, defer=False):
+        """Like get_parsed_records_for_pid, but for several record types at once (see check_sources_by_type).
+        Returns a dict of record type name -> pairs of (record, score). Each record is only fetched once, even if
+        it is of more than one type.
+        """
+        print(f'Working on {pid}...')
+        by_type = self.check_sources_by_type(pid, patterns, defer)
+        records = {}
+        for arkids in by_type.values():
+            for arkid, _ in arkids:
+                if arkid not in records:
+                    records[arkid] = self.get_record(arkid, defer)
+        return {name: [(records[arkid], score) for arkid, score in arkids] for name, arkids in by_type.items()}
+
     def get_records_for_pid(self, pid, lookfor):
         """Gets record data for a person with the record descriptions matching a given word/pattern
 
         pid (str): the person to look for records for
         lookfor (str): a regular expression to look for in record descriptions (e.g. r'[Cc]ensus' for census records)
         """
+        accumulator = RecordAccumulator()
+        accumulator.add_pid(pid, self.get_parsed_records_for_pid(pid, lookfor))
+        return accumulator.build()
+
+    def start_pid(self, executor, pid, lookfor):
+        """Finds the records for a PID and submits a get_record job to executor for each of them.
+        Returns pairs of (future, score) without waiting on the futures, so it is safe to run inside executor itself.
+        """
+        return self.start_pid_by_type(executor, pid, {None: lookfor})[None]
+
+    def start_pid_by_type(self, executor, pid, patterns, defer=False):
+        """Like start_pid, but for several record types at once (see check_sources_by_type).
+        Returns a dict of record type name -> pairs of (future, score). A record of more than one type is only
+        submitted once, and its future shared between the types.
+        defer (bool): whether to raise retry.CircuitOpen if the circuit breaker of an endpoint is open (see api_get)
+        """
         print(f'Working on {pid}...')
-        arkids = self.check_all_sources(pid, lookfor)
-        if arkids:
-            df = pd.concat((self.process_record(arkid, score) for arkid, score in arkids), sort=True)
-            df['PID'] = [pid]*len(df)
-            return df
-        else:
-            return pd.DataFrame()
+        by_type = self.check_sources_by_type(pid, patterns, defer)
+        futures = {}
+        for arkids in by_type.values():
+            for arkid, _ in arkids:
+                if arkid not in futures:
+                    futures[arkid] = executor.submit(self.get_record, arkid, defer)
+        return {name: [(futures[arkid], score) for arkid, score in arkids] for name, arkids in by_type.items()}
+
+    def iter_parsed_records_for_pids(self, pids, lookfor):
+        """Like get_parsed_records_for_pid, but for an iterable of PIDs.
+        Yields (pid, records) for each PID, in the order of pids. See iter_parsed_records_by_type.
+        """
+        for pid, by_type in self.iter_parsed_records_by_type(pids, {None: lookfor}):
+            yield pid, by_type[None]
+
+    def iter_parsed_records_by_type(self, pids, patterns):
+        """Like get_parsed_records_by_type, but for an iterable of PIDs.
+        Yields (pid, dict of record type name -> records) for each PID, in the order of pids.
+
+        If self.workers > 1, up to that many requests are kept in flight at once, both across PIDs and across
+        the ark IDs of each PID. If the circuit breaker of an endpoint a PID needs is open (see retry), the PID is
+        put aside so that the workers can get on with other PIDs, and started again once the breaker lets requests
+        through.
+        """
+        patterns = compile_patterns(patterns)
+        if self.workers <= 1:
+            for pid in pids:
+                while True:
+                    try:
+                        by_type = self.get_parsed_records_by_type(pid, patterns, defer=True)
+                        break
+                    except retry.CircuitOpen as e:
+                        self.defer_pid(pid, e)
+                self.count_done(by_type)
+                yield pid, by_type
+            return
+        pids = iter(pids)
+        # How many PIDs to have started ahead of the one currently being yielded
+        window = 2*self.workers
+        pending = deque()
+        executor = ThreadPoolExecutor(max_workers=self.workers)
+
+        def fill():
+            for pid in pids:
+                pending.append((pid, executor.submit(self.start_pid_by_type, executor, pid, patterns, True)))
+                if len(pending) >= window:
+                    break
+
+        try:
+            fill()
+            while pending:
+                pid, future = pending.popleft()
+                fill()
+                while True:
+                    try:
+                        by_type = {name: [(f.result(), score) for f, score in futures]
+                                   for name, futures in future.result().items()}
+                        break
+                    except retry.CircuitOpen as e:
+                        self.defer_pid(pid, e)
+                        future = executor.submit(self.start_pid_by_type, executor, pid, patterns, True)
+                self.count_done(by_type)
+                yield pid, by_type
+        finally:
+            executor.shutdown(wait=True, cancel_futures=True)
+
+    @staticmethod
+    def defer_pid(pid, circuit_open):
+        """Waits until the circuit breaker that stopped the requests for a PID may let requests through again"""
+        # The PID may have been put aside a while ago, so ask the breaker how much longer it is open for
+        wait = retry.get_breaker(circuit_open.endpoint).retry_in()
+        print(f'Putting {pid} aside for {wait:.1f} seconds ({circuit_open.endpoint} is failing)')
+        metrics.inc('pids_deferred_total', endpoint=circuit_open.endpoint)
+        time.sleep(wait)
+
+    @staticmethod
+    def count_done(by_type):
+        """Counts a PID with records (a dict of record type name -> pairs of (record, score)) towards the progress
+        of the run (see metrics)
+        """
+        metrics.inc('pids_done_total')
+        for name, records in by_type.items():
+            metrics.inc('records_total', sum(record is not None for record, _ in records),
+                        **({'type': name} if name is not None else {}))
+
+    def iter_records_for_pids(self, pids, lookfor):
+        """Like get_records_for_pid, but for an iterable of PIDs. Yields one DataFrame per PID, in the order of pids.
+        See iter_parsed_records_for_pids.
+        """
+        for pid, records in self.iter_parsed_records_for_pids(pids, lookfor):
+            accumulator = RecordAccumulator()
+            accumulator.add_pid(pid, records)
+            yield accumulator.build()
+
+    def iter_record_batches(self, pids, lookfor, batch_size=1000):
+        """Gets the record data for an iterable of PIDs, batch_size PIDs at a time.
+        Yields pairs of (number of PIDs, DataFrame) for each batch, in the order of pids. Concatenated, the DataFrames
+        are the same as concatenating the ones from get_records_for_pid for each PID.
+        """
+        for count, dfs in self.iter_record_batches_by_type(pids, {None: lookfor}, batch_size):
+            yield count, dfs[None]
+
+    def iter_record_batches_by_type(self, pids, patterns, batch_size=1000):
+        """Like iter_record_batches, but for several record types at once (see check_sources_by_type).
+        Yields pairs of (number of PIDs, dict of record type name -> DataFrame) for each batch.
+        """
+        accumulators = {name: RecordAccumulator() for name in patterns}
+        count = 0
+        for pid, by_type in self.iter_parsed_records_by_type(pids, patterns):
+            for name, records in by_type.items():
+                accumulators[name].add_pid(pid, records)
+            count += 1
+            if count >= batch_size:
+                yield count, {name: accumulator.build() for name, accumulator in accumulators.items()}
+                accumulators = {name: RecordAccumulator() for name in patterns}
+                count = 0
+        if count:
+            yield count, {name: accumulator.build() for name, accumulator in accumulators.items()}
+
+    def get_records_for_pids(self, pids, lookfor):
+        """Gets the record data for an iterable of PIDs as a single DataFrame, with rows in the order of pids"""
+        return self.get_records_for_pids_by_type(pids, {None: lookfor})[None]
+
+    def get_records_for_pids_by_type(self, pids, patterns):
+        """Like get_records_for_pids, but for several record types at once (see check_sources_by_type).
+        Returns a dict of record type name -> DataFrame.
+        """
+        accumulators = {name: RecordAccumulator() for name in patterns}
+        for pid, by_type in self.iter_parsed_records_by_type(pids, patterns):
+            for name, records in by_type.items():
+                accumulators[name].add_pid(pid, records)
+        return {name: accumulator.build() for name, accumulator in accumulators.items()}
 
 
 def process_year(yr):
@@ -278,41 +803,75 @@ def dedup(df):
     Also drops records with duplicate PID and year based on their confidence scores.
     If no record has a best confidence score, all will be dropped.
     """
-    df_person = df[df['is_person']==1]
-    duplicates = df_person[df_person.duplicated(['PID', 'year'], keep=False)]
-    grouped = duplicates.groupby(['PID', 'year'])
-    to_keep = []
-    for group in grouped.groups:
-        dups = grouped.get_group(group)
-        max_score = dups.score.max()
-        dups = dups[dups.score == max_score]
-        if len(dups) == 1:
-            to_keep.append(dups.index[0])
-    to_drop = duplicates.index.difference(pd.Index(to_keep))
-    return df_person.drop(index=to_drop)
-#        for column in dups.columns:
-#            notna = pd.notna(dups[column])
-#            if notna.sum() > 1:
-#                dups[column] = [np.nan]*len(dups)
-#            else:
-#                dups[column] = np.repeat(dups[column][notna].unique(), len(dups))
-#        to_keep.append(dups.iloc[0])    
+    with metrics.timer('dedup'):
+        df_person = df[df['is_person']==1]
+        duplicated = df_person.duplicated(['PID', 'year'], keep=False)
+        duplicates = df_person[duplicated]
+        # Rows with a missing PID or year don't belong to any group, so are never kept (as with groupby)
+        grouped = duplicates.groupby(['PID', 'year'])['score']
+        is_top = duplicates['score'] == grouped.transform('max')
+        top_count = is_top.groupby([duplicates['PID'], duplicates['year']]).transform('sum')
+        keep = is_top & (top_count == 1)
+        # Drop by index label, keeping any label that belongs to a row that is kept
+        to_drop = duplicates.index[~keep.to_numpy()].difference(duplicates.index[keep.to_numpy()])
+        return df_person.drop(index=to_drop)
+
+
+class ColumnMapping(object):
+    """A compiled version of a columns file (like census_columns.json), which maps each column of the condensed data
+    to the list of columns of the uncondensed data it is merged from, in order of preference.
+
+    columndict (dict): target column name -> list of source column names
+    """
+
+    def __init__(self, columndict):
+        self.columndict = {k: list(v) for k, v in columndict.items()}
+
+    @classmethod
+    def from_json(cls, columns_file):
+        """Returns the ColumnMapping for a columns file. Each file is only read once (unless it changes)."""
+        key = (os.path.abspath(columns_file), os.path.getmtime(columns_file))
+        if key not in _column_mappings:
+            with open(columns_file, 'r') as fh:
+                _column_mappings[key] = cls(json.load(fh))
+        return _column_mappings[key]
+
+    def resolve(self, columns):
+        """Returns a dict of target column -> the source columns for it that are actually in columns"""
+        columns = set(columns)
+        return {k: [x for x in sources if x in columns] for k, sources in self.columndict.items()}
+
+    def apply(self, df_in):
+        """Condenses df_in: each target column takes the first non-missing value among its source columns.
+        Exact duplicate rows in the result are dropped.
+        """
+        plan = self.resolve(df_in.columns)
+        if not any(plan.values()):
+            return pd.DataFrame(columns=list(plan))
+        data = {}
+        for k, sources in plan.items():
+            if not sources:
+                data[k] = pd.Series(np.nan, index=df_in.index, dtype=object)
+                continue
+            column = df_in[sources[0]]
+            for x in sources[1:]:
+                missing = column.isna()
+                if not missing.any():
+                    break
+                column = column.where(~missing, df_in[x])
+            data[k] = column
+        return pd.DataFrame(data, index=df_in.index).drop_duplicates()
+
+
+_column_mappings = {}
 
 
 def condense_record(df_in, columns_file):
     """Takes a Pandas DataFrame of record data and merges/drops some of the columns to create a more compact dataset
     The column names to be retained and merged together are in the columns_file in JSON format.
     """
-    with open(columns_file, 'r') as fh:
-        columndict = json.load(fh)
-    df_out = pd.DataFrame(columns=list(columndict.keys()))
-    for k in columndict.keys():
-        for x in columndict[k]:
-            try:
-                df_out[k] = df_out[k].combine_first(df_in[x])
-            except KeyError:
-                pass
-    return df_out.drop_duplicates()
+    with metrics.timer('condense'):
+        return ColumnMapping.from_json(columns_file).apply(df_in)
 
 
 def condense_census(df_in):
@@ -330,20 +889,77 @@ def condense_death_records(df_in):
     return df_out
 
 
-def get_records_for_pids_in_csv(lookfor, filename, col_name='PID'):
+# Condense function -> the columns file that declares the schema of its output (see columnar.schema_for)
+COLUMNS_FILES = {
+    condense_census: CENSUS_COLUMNS,
+    condense_death_records: DEATH_RECORD_COLUMNS,
+}
+
+# Record type name -> (the regex pattern for its descriptions, the function to condense it with), for the types this
+# module knows how to condense. Other types can be given to the *_by_type functions with their own pattern.
+RECORD_TYPES = {
+    'census': (CENSUS_PTTRN, condense_census),
+    'deaths': (DEATH_PTTRN, condense_death_records),
+}
+
+
+def get_records_for_pids_in_csv(lookfor, filename, col_name='PID', workers=1, response_cache=None, journal=None,
+                                checkpoint_every=100, **sourcer_kwargs):
     """Takes a CSV with a PID column and creates a Pandas DataFrame with all the record data for those PIDs.
 
     lookfor (str): the regex pattern used to identify record types from their descriptions, e.g. '[Cc]ensus' for census
     filename (str): the file name of the CSV to get the PIDs from
     col_name (str): the name of the column that contains the PIDs
+    workers (int): the number of requests to keep in flight at once. Rows come out in input order regardless.
+    response_cache (cache.ResponseCache, optional): a cache to read API responses through
+    journal (str, optional): a directory to journal progress to (see runjournal.RunJournal). If the directory holds
+        a journal from an earlier, unfinished run with the same input, the PIDs it already did are skipped.
+    checkpoint_every (int): if journaling, how many PIDs to do between writes to the journal
+    Any other keyword arguments are passed on to FamilySearchSourcer (e.g. parse_processes).
     """
     df_in = pd.read_csv(filename)
-    fss = FamilySearchSourcer()
-    df_out = pd.concat((fss.get_records_for_pid(pid, lookfor) for pid in df_in[col_name])).reset_index(drop=True)
-    return df_out
+    pids = df_in[col_name]
+    if journal is None:
+        metrics.get_metrics().set('pids_expected', len(pids))
+        with FamilySearchSourcer(workers=workers, response_cache=response_cache, **sourcer_kwargs) as fss:
+            return fss.get_records_for_pids(pids, lookfor).reset_index(drop=True)
+    journal = runjournal.RunJournal(journal, lookfor, pids)
+    if journal.done < len(pids):
+        metrics.get_metrics().set('pids_expected', len(pids) - journal.done)
+        with FamilySearchSourcer(workers=workers, response_cache=response_cache, **sourcer_kwargs) as fss:
+            for count, df in fss.iter_record_batches(pids[journal.done:], lookfor, checkpoint_every):
+                journal.record(count, df)
+    return journal.load().reset_index(drop=True)
+
+
+def get_persons_for_pids_in_csv(filename, col_name='PID', saveas=None, workers=1, response_cache=None):
+    """Looks up the PIDs in a CSV in the tree (see FamilySearchSourcer.get_persons_for_pids), e.g. to check which
+    still exist before getting their records.
+
+    saveas (str, optional): a file name to save the outputted DataFrame in CSV format
+    workers (int): the number of batched requests to keep in flight at once
+    """
+    pids = pd.read_csv(filename, usecols=[col_name])[col_name]
+    with FamilySearchSourcer(workers=workers, response_cache=response_cache, reuse_households=False) as fss:
+        df = fss.get_persons_for_pids(pids)
+    if saveas is not None:
+        df.to_csv(saveas, index=False)
+    return df
+
+
+def journal_for(saveas):
+    """The journal directory used for a checkpointed run saving to saveas"""
+    if saveas is None:
+        raise ValueError('saveas must be provided to checkpoint a run')
+    return saveas + '.journal'
 
 
-def condense_and_save(df, saveas=None, condense=None, save_uncondensed=True, append=True):
+def uncondensed_name(saveas):
+    """The file name the uncondensed data is saved at when the condensed data is saved at saveas"""
+    return re.sub(r'\..{3,4}$', '_uncondensed.csv', saveas)
+
+
+def condense_and_save(df, saveas=None, condense=None, save_uncondensed=True, append=True, output=None):
     """Saves DataFrame to CSV, with options to condense data first and save uncondensed version as well
 
     df (DataFrame): the data to save
@@ -351,10 +967,14 @@ def condense_and_save(df, saveas=None, condense=None, save_uncondensed=True, app
     condense (function, optional): if provided, the function to use to condense the data (e.g. condense_census)
     save_uncondensed (bool): if saveas isprovided and condense is True, determines whether to also save uncondensed data
     append (bool): If the saveas file already exists, whether to append to that file or just replace it.
+    output (columnar.ColumnarOutput, optional): if provided, save to Parquet/Arrow datasets instead of CSV (see
+        save_columnar)
     """
+    if output is not None:
+        return save_columnar(df, saveas, condense, save_uncondensed, append, output)
     if condense is not None:
         if (saveas is not None) and save_uncondensed:
-            saveas_condensed = re.sub(r'\..{3,4}$', '_uncondensed.csv', saveas)
+            saveas_condensed = uncondensed_name(saveas)
             if append and os.path.isfile(saveas_condensed):
                 with open(saveas_condensed, 'a') as fh:
                     df.to_csv(fh, header=False, index=False)
@@ -370,20 +990,373 @@ def condense_and_save(df, saveas=None, condense=None, save_uncondensed=True, app
     return df
 
 
-def get_census_for_pids_in_csv(filename, col_name='PID', saveas=None, condense=True, save_uncondensed=True):
+def save_columnar(df, saveas=None, condense=None, save_uncondensed=True, append=True, output=None):
+    """Like condense_and_save, but saves to Parquet/Arrow datasets (see columnar.ColumnarOutput).
+    saveas is a directory, and the uncondensed data goes in the one named by columnar.uncondensed_path. Appending
+    adds new part files to the datasets rather than rewriting them. Condensed data is written with the schema
+    declared by the columns file of condense (see COLUMNS_FILES).
+    """
+    output = output or columnar.ColumnarOutput()
+    if condense is not None:
+        if (saveas is not None) and save_uncondensed:
+            output.write(df, columnar.uncondensed_path(saveas), append=append)
+        df = condense(df)
+    if saveas is not None:
+        schema = columnar.schema_for(COLUMNS_FILES[condense]) if condense in COLUMNS_FILES else None
+        output.write(df, saveas, schema, append)
+    return df
+
+
+def read_pids_in_chunks(filename, col_name='PID', chunksize=1000):
+    """Yields the PIDs in the col_name column of a CSV, reading only chunksize rows of it into memory at a time"""
+    for chunk in pd.read_csv(filename, usecols=[col_name], chunksize=chunksize):
+        yield from chunk[col_name]
+
+
+def csv_header(filename):
+    """Returns the column names in the header of a CSV"""
+    return list(pd.read_csv(filename, nrows=0).columns)
+
+
+def stitch_csv_parts(parts, columns, saveas, append=True):
+    """Writes the CSV files in parts one after another to saveas, lined up under a single header.
+
+    parts (list): the CSV files to put together, which may each have a different subset of the columns
+    columns (list): all the column names, in the order they should appear
+    saveas (str): the file to write to
+    append (bool): if saveas already exists, whether to add to it rather than replace it. If the parts have columns
+        that aren't in its header, the existing file is rewritten with the wider header.
+    Only one part (in chunks) is held in memory at a time.
+    """
+    read_kwargs = {'dtype': str, 'keep_default_na': False, 'chunksize': 10000}
+    if append and os.path.isfile(saveas):
+        existing = csv_header(saveas)
+        new_columns = [c for c in columns if c not in existing]
+        if not new_columns:
+            with open(saveas, 'a', newline='') as fh:
+                for part in parts:
+                    for chunk in pd.read_csv(part, **read_kwargs):
+                        chunk.reindex(columns=existing).to_csv(fh, header=False, index=False)
+            return
+        columns = existing + new_columns
+        parts = [saveas] + parts
+    tmp = saveas + '.tmp'
+    with open(tmp, 'w', newline='') as fh:
+        pd.DataFrame(columns=columns).to_csv(fh, index=False)
+        for part in parts:
+            for chunk in pd.read_csv(part, **read_kwargs):
+                chunk.reindex(columns=columns).to_csv(fh, header=False, index=False)
+    os.replace(tmp, saveas)
+
+
+def stream_records_for_pids_in_csv(lookfor, filename, saveas, condense=None, col_name='PID', chunksize=1000,
+                                   save_uncondensed=True, dedup_condensed=False, append=True, workers=1,
+                                   response_cache=None, output=None, **sourcer_kwargs):
+    """Like get_records_for_pids_in_csv followed by condense_and_save, but holds only about chunksize PIDs worth of
+    data in memory at a time, no matter how big the input is. PIDs are read from the input chunksize at a time, and
+    streamed through stream_records_for_pids (see that for the other arguments).
+
+    filename (str): the file name of the CSV to get the PIDs from
+    col_name (str): the name of the column that contains the PIDs
+    """
+    stream_records_for_pids(lookfor, read_pids_in_chunks(filename, col_name, chunksize), saveas, condense,
+                            chunksize, save_uncondensed, dedup_condensed, append, workers, response_cache, output,
+                            **sourcer_kwargs)
+
+
+class ChunkWriter(object):
+    """Saves the records of a streamed run (see stream_records_for_pids) one chunk at a time.
+
+    Each chunk is condensed and appended to saveas, and its uncondensed rows are set aside in a temporary part file.
+    Since different chunks have different uncondensed columns, the parts are put together under one header by
+    finish() (see stitch_csv_parts). With columnar output, each chunk is instead added to the datasets as new part
+    files, so there is nothing to put together. close() removes any part files left over.
+
+    saveas (str): the file name to save the (condensed, if condense is provided) output to
+    condense (function, optional): the function to use to condense each chunk (e.g. condense_census)
+    save_uncondensed (bool): if condense is provided, whether to also save the uncondensed data
+    dedup_condensed (bool): whether to run dedup on each chunk after condensing
+    append (bool): If the output files already exist, whether to append to them or replace them
+    output (columnar.ColumnarOutput, optional): if provided, save to Parquet/Arrow datasets instead of CSV
+    """
+
+    def __init__(self, saveas, condense=None, save_uncondensed=True, dedup_condensed=False, append=True,
+                 output=None):
+        self.saveas = saveas
+        self.condense = condense
+        self.dedup_condensed = dedup_condensed
+        self.append = append
+        self.output = output
+        self.raw_saveas = uncondensed_name(saveas) if condense is not None else saveas
+        self.keep_raw = condense is None or save_uncondensed
+        self.parts = []
+        self.columns = []
+        self.write_header = not (append and os.path.isfile(saveas))
+        self.schema = None
+        if output is not None and condense in COLUMNS_FILES:
+            self.schema = columnar.schema_for(COLUMNS_FILES[condense])
+
+    def write(self, df):
+        """Saves a chunk of uncondensed records"""
+        df = df.reset_index(drop=True)
+        if self.output is not None:
+            if self.keep_raw:
+                raw_path = columnar.uncondensed_path(self.saveas) if self.condense is not None else self.saveas
+                self.output.write(df, raw_path, append=self.append)
+            if self.condense is not None:
+                df = self.condense_chunk(df)
+                self.output.write(df, self.saveas, self.schema, self.append)
+            self.append = True
+            return
+        if self.keep_raw and len(df):
+            part = '{}.part{:05d}'.format(self.raw_saveas, len(self.parts))
+            df.to_csv(part, index=False)
+            self.parts.append(part)
+            self.columns.extend(c for c in df.columns if c not in self.columns)
+        if self.condense is not None:
+            df = self.condense_chunk(df)
+            df.to_csv(self.saveas, mode='w' if self.write_header else 'a', header=self.write_header, index=False)
+            self.write_header = False
+
+    def condense_chunk(self, df):
+        df = self.condense(df)
+        return dedup(df) if self.dedup_condensed else df
+
+    def finish(self):
+        """Puts the uncondensed part files together, once all the chunks are written"""
+        if self.parts:
+            stitch_csv_parts(self.parts, self.columns, self.raw_saveas, self.append)
+
+    def close(self):
+        for part in self.parts:
+            if os.path.isfile(part):
+                os.remove(part)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def for_type(value, name):
+    """The setting for record type name, where value is either a dict of record type name -> setting, or one
+    setting for every type
+    """
+    return value.get(name) if isinstance(value, dict) else value
+
+
+def stream_records_for_pids(lookfor, pids, saveas, condense=None, chunksize=1000, save_uncondensed=True,
+                            dedup_condensed=False, append=True, workers=1, response_cache=None, output=None,
+                            **sourcer_kwargs):
+    """Gets the records for an iterable of PIDs and saves them (as condense_and_save) chunksize PIDs at a time.
+    pids is only read as the work gets to it, so it can be a generator that is still producing PIDs (e.g. from
+    pipeline.find_and_save_records).
+
+    Each chunk is saved as soon as its records are fetched (see ChunkWriter). All of a PID's rows always end up
+    in the same chunk, so dedup gives the same result per chunk as it would on the whole data. A PID that comes up
+    more than once is only done the first time.
+
+    lookfor (str): the regex pattern used to identify record types from their descriptions
+    pids (iterable): the PIDs to get the records for
+    saveas (str): the file name to save the (condensed, if condense is provided) output to
+    condense (function, optional): the function to use to condense each chunk (e.g. condense_census)
+    chunksize (int): the number of PIDs per chunk
+    save_uncondensed (bool): if condense is provided, whether to also save the uncondensed data
+    dedup_condensed (bool): whether to run dedup on each chunk after condensing (needs 'PID', 'year' and 'score'
+        columns in the condensed data, as with condense_census)
+    append (bool): If the output files already exist, whether to append to them or replace them
+    workers (int): the number of requests to keep in flight at once
+    response_cache (cache.ResponseCache, optional): a cache to read API responses through
+    output (columnar.ColumnarOutput, optional): if provided, save to Parquet/Arrow datasets instead of CSV
+    Any other keyword arguments are passed on to FamilySearchSourcer.
+    """
+    stream_records_by_type({None: (lookfor, condense)}, pids, {None: saveas}, chunksize, save_uncondensed,
+                           dedup_condensed, append, workers, response_cache, output, **sourcer_kwargs)
+
+
+def stream_records_by_type(record_types, pids, saveas, chunksize=1000, save_uncondensed=True, dedup_condensed=False,
+                           append=True, workers=1, response_cache=None, output=None, **sourcer_kwargs):
+    """Like stream_records_for_pids, but for several record types at once: the sources of each PID are only
+    looked up once, and each record only fetched once, whichever types it is of. Each type is saved separately.
+
+    record_types (dict): record type name -> (the regex pattern for its descriptions, the function to condense it
+        with or None), e.g. RECORD_TYPES
+    saveas (dict): record type name -> the file name to save its output to
+    dedup_condensed (bool or dict): whether to run dedup on each chunk after condensing, or a dict of record type
+        name -> whether to for that type
+    output (columnar.ColumnarOutput or dict, optional): if provided, save to Parquet/Arrow datasets instead of CSV.
+        May be a dict of record type name -> ColumnarOutput (or None for CSV).
+    The other arguments are as for stream_records_for_pids.
+    """
+    seen = set()
+
+    def new_pids():
+        for pid in pids:
+            if pid not in seen:
+                seen.add(pid)
+                yield pid
+
+    patterns = {name: pattern for name, (pattern, _) in record_types.items()}
+    # Keep the household index from growing with the run, so that memory stays bounded by the chunk size
+    sourcer_kwargs.setdefault('index_size', persona_index.for_chunksize(chunksize))
+    with ExitStack() as stack:
+        fss = stack.enter_context(FamilySearchSourcer(workers=workers, response_cache=response_cache,
+                                                      **sourcer_kwargs))
+        writers = {
+            name: stack.enter_context(ChunkWriter(
+                saveas[name], condense, save_uncondensed,
+                for_type(dedup_condensed, name), append, for_type(output, name)
+            )) for name, (_, condense) in record_types.items()
+        }
+        for _, dfs in fss.iter_record_batches_by_type(new_pids(), patterns, chunksize):
+            for name, df in dfs.items():
+                writers[name].write(df)
+        for writer in writers.values():
+            writer.finish()
+
+
+def get_and_save_records_for_pids_in_csv(lookfor, condense, filename, col_name='PID', saveas=None,
+                                         save_uncondensed=True, workers=1, response_cache=None, checkpoint=False,
+                                         chunksize=None, output=None, **sourcer_kwargs):
+    """Runs get_records_for_pids_in_csv, then condenses and saves the results with condense_and_save.
+    The work behind get_census_for_pids_in_csv and get_deaths_for_pids_in_csv; see those for the arguments.
+
+    condense (function, optional): the function to condense the data with (e.g. condense_census)
+    """
+    if chunksize is not None:
+        if saveas is None or checkpoint:
+            raise ValueError('Streaming (chunksize) needs saveas, and cannot be combined with checkpoint')
+        stream_records_for_pids_in_csv(lookfor, filename, saveas, condense, col_name, chunksize, save_uncondensed,
+                                       workers=workers, response_cache=response_cache, output=output,
+                                       **sourcer_kwargs)
+        return
+    journal = journal_for(saveas) if checkpoint else None
+    df_out = get_records_for_pids_in_csv(lookfor, filename, col_name, workers, response_cache, journal,
+                                         **sourcer_kwargs)
+    df_out = condense_and_save(df_out, saveas, condense, save_uncondensed, output=output)
+    if journal is not None:
+        shutil.rmtree(journal, ignore_errors=True)
+    return df_out
+
+
+def get_census_for_pids_in_csv(filename, col_name='PID', saveas=None, condense=True, save_uncondensed=True,
+                               workers=1, response_cache=None, checkpoint=False, chunksize=None, output=None,
+                               **sourcer_kwargs):
     """Runs get_records_for_pids_in_csv, looking for census records. With options to condense results and save.
 
     saveas (str, optional): a file name to save the outputted DataFrame in CSV format
     condense (bool): whether or not to run condense_census on the data before outputting
     save_uncondensed (bool): if saveas isprovided and condense is True, determines whether to also save uncondensed data
+    workers (int): the number of requests to keep in flight at once (see FamilySearchSourcer.iter_parsed_records_for_pids)
+    response_cache (cache.ResponseCache, optional): a cache to read API responses through
+    checkpoint (bool): whether to journal progress next to saveas, so that re-running with the same filename and
+        saveas after a crash picks up where the last run stopped. The journal is deleted once the output is saved.
+    chunksize (int, optional): if provided, stream the run this many PIDs at a time with bounded memory instead
+        (see stream_records_for_pids_in_csv). saveas must be provided, and nothing is returned.
+    output (columnar.ColumnarOutput, optional): if provided, save to Parquet/Arrow datasets at saveas (a directory)
+        instead of CSV files (see save_columnar)
+    Any other keyword arguments are passed on to FamilySearchSourcer (e.g. parse_processes).
     """
-    df_out = get_records_for_pids_in_csv(CENSUS_PTTRN, filename, col_name)
-    df_out = condense_and_save(df_out, saveas, condense_census if condense else None, save_uncondensed)
-    return df_out
+    return get_and_save_records_for_pids_in_csv(CENSUS_PTTRN, condense_census if condense else None, filename,
+                                                col_name, saveas, save_uncondensed, workers, response_cache,
+                                                checkpoint, chunksize, output, **sourcer_kwargs)
 
 
-def get_deaths_for_pids_in_csv(filename, col_name='PID', saveas=None, condense=True, save_uncondensed=True):
+def get_deaths_for_pids_in_csv(filename, col_name='PID', saveas=None, condense=True, save_uncondensed=True,
+                               workers=1, response_cache=None, checkpoint=False, chunksize=None, output=None,
+                               **sourcer_kwargs):
     """Runs get_records_for_pids_in_csv, looking for death records. With options to condense results and save."""
-    df_out = get_records_for_pids_in_csv(DEATH_PTTRN, filename, col_name)
-    df_out = condense_and_save(df_out, saveas, condense_death_records if condense else None, save_uncondensed)
-    return df_out
+    return get_and_save_records_for_pids_in_csv(DEATH_PTTRN, condense_death_records if condense else None, filename,
+                                                col_name, saveas, save_uncondensed, workers, response_cache,
+                                                checkpoint, chunksize, output, **sourcer_kwargs)
+
+
+def saveas_by_type(saveas, names):
+    """Returns a dict of record type name -> the file name to save that type at, from saveas with the name added
+    before the extension (e.g. 'records.csv' -> 'records_census.csv'). A dict for saveas is returned as is.
+    """
+    if isinstance(saveas, dict):
+        return saveas
+    root, ext = os.path.splitext(saveas)
+    return {name: f'{root}_{name}{ext}' for name in names}
+
+
+def get_and_save_records_by_type(filename, record_types, saveas, col_name='PID', save_uncondensed=True, workers=1,
+                                 response_cache=None, chunksize=None, output=None, **sourcer_kwargs):
+    """Gets the records of several types for the PIDs in a CSV in a single run, then condenses and saves each type
+    separately (as get_and_save_records_for_pids_in_csv does for one type). The sources of each PID are only looked
+    up once, and each record only fetched once, however many types there are.
+    Returns a dict of record type name -> DataFrame (as saved), or nothing if streaming.
+
+        # Saves records_census.csv and records_deaths.csv (and their uncondensed data)
+        get_and_save_records_by_type('pids.csv', RECORD_TYPES, 'records.csv')
+
+    filename (str): the file name of the CSV to get the PIDs from
+    record_types (dict): record type name -> (the regex pattern for its descriptions, the function to condense it
+        with or None), e.g. RECORD_TYPES or {'census': RECORD_TYPES['census'], 'marriages': (r'[Mm]arriage', None)}
+    saveas (str or dict): the file name to save each type at (see saveas_by_type), or a dict of record type name ->
+        file name
+    col_name (str): the name of the column that contains the PIDs
+    save_uncondensed (bool): for types with a condense function, whether to also save the uncondensed data
+    workers (int): the number of requests to keep in flight at once
+    response_cache (cache.ResponseCache, optional): a cache to read API responses through
+    chunksize (int, optional): if provided, stream the run this many PIDs at a time with bounded memory instead
+        (see stream_records_by_type)
+    output (columnar.ColumnarOutput or dict, optional): if provided, save to Parquet/Arrow datasets instead of CSV
+        files. May be a dict of record type name -> ColumnarOutput.
+    Any other keyword arguments are passed on to FamilySearchSourcer (e.g. parse_processes).
+    """
+    saveas = saveas_by_type(saveas, record_types)
+    if chunksize is not None:
+        stream_records_by_type(record_types, read_pids_in_chunks(filename, col_name, chunksize), saveas, chunksize,
+                               save_uncondensed, workers=workers, response_cache=response_cache, output=output,
+                               **sourcer_kwargs)
+        return
+    pids = pd.read_csv(filename)[col_name]
+    metrics.get_metrics().set('pids_expected', len(pids))
+    patterns = {name: pattern for name, (pattern, _) in record_types.items()}
+    with FamilySearchSourcer(workers=workers, response_cache=response_cache, **sourcer_kwargs) as fss:
+        dfs = fss.get_records_for_pids_by_type(pids, patterns)
+    return {name: condense_and_save(dfs[name].reset_index(drop=True), saveas[name], condense, save_uncondensed,
+                                    output=for_type(output, name))
+            for name, (_, condense) in record_types.items()}
+
+
+def replay_pids(archive_path, lookfor, pids):
+    """Gets the records for pids from the response archive at archive_path, as from
+    FamilySearchSourcer.get_records_for_pids. Runs in the worker processes of replay_records.
+    """
+    with archive.ResponseArchive(archive_path, archive.REPLAY) as response_archive:
+        with FamilySearchSourcer(response_archive=response_archive) as fss:
+            return fss.get_records_for_pids(pids, lookfor)
+
+
+def replay_records(archive_path, lookfor, saveas=None, condense=None, save_uncondensed=True, filename=None,
+                   col_name='PID', processes=None, chunksize=1000, output=None):
+    """Rebuilds the output of a run from the responses captured in a response archive (see archive.ResponseArchive),
+    without any requests to the API. The PIDs are split into chunks that are replayed in parallel processes.
+
+    archive_path (str): the directory of the response archive
+    lookfor (str): the regex pattern used to identify record types from their descriptions. Records that were not
+        captured (e.g. because they didn't match the pattern used for the capture) are left out.
+    saveas (str, optional): a file name to save the outputted DataFrame at
+    condense (function, optional): the function to condense the data with (e.g. condense_census)
+    save_uncondensed (bool): if saveas is provided and condense is not None, whether to also save uncondensed data
+    filename (str, optional): a CSV with the PIDs to replay in a col_name column. Defaults to every PID in the
+        archive, in the order they were captured.
+    processes (int, optional): the number of processes to use. Defaults to the number of CPUs.
+    chunksize (int): the number of PIDs each process replays at a time
+    output (columnar.ColumnarOutput, optional): if provided, save to Parquet/Arrow datasets instead of CSV
+    """
+    if filename is not None:
+        pids = list(pd.read_csv(filename)[col_name])
+    else:
+        with archive.ResponseArchive(archive_path, archive.REPLAY) as response_archive:
+            pids = response_archive.idents('sources')
+    chunks = [pids[i:i + chunksize] for i in range(0, len(pids), chunksize)]
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        dfs = list(executor.map(replay_pids, repeat(archive_path), repeat(lookfor), chunks))
+    dfs = [df for df in dfs if not df.empty]
+    df_out = pd.concat(dfs, sort=False).reset_index(drop=True) if dfs else pd.DataFrame()
+    return condense_and_save(df_out, saveas, condense, save_uncondensed, append=False, output=output)
@@ -0,0 +1,294 @@
+# -*- coding: utf-8 -*-
+"""
+Run metrics: counts and latency histograms of requests by endpoint and status code, time spent waiting on the rate
+limiter and on Retry-After pauses, retries, and time spent in each processing stage (parsing records, building
+DataFrames, condensing, deduplicating).
+
+The session, ratelimit, retry, authenticate, find and get_sources modules all record into one shared Metrics registry
+(see get_metrics). To watch a run, wrap it in an Exporter, which writes a snapshot of the registry every few seconds
+(as JSON, or as a Prometheus textfile if the file name ends with .prom) and prints the progress of the run:
+    with metrics.Exporter('run_metrics.json'):
+        get_sources.get_census_for_pids_in_csv('pids.csv', saveas='census.csv', workers=8)
+"""
+
+import bisect
+import json
+import os
+import re
+import threading
+import time
+from contextlib import contextmanager
+
+
+# Upper bounds (in seconds) of the histogram buckets
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1., 2.5, 5., 10., 30., 60.)
+# Prefix of the metric names in Prometheus textfiles
+PREFIX = 'familysearch_'
+# Default seconds between snapshots written by an Exporter
+INTERVAL = 10.
+
+# Endpoints of the API, by a pattern matching the path of their URLs. The first that matches is used.
+ENDPOINTS = [
+    ('personas', re.compile(r'/platform/records/personas/')),
+    ('sources', re.compile(r'/platform/tree/persons/[^/]+/sources')),
+    ('matches', re.compile(r'/platform/tree/persons/[^/]+/matches')),
+    ('tree_matches', re.compile(r'/platform/tree/matches')),
+    ('persons', re.compile(r'/platform/tree/persons')),
+    ('token', re.compile(r'/oauth2/')),
+]
+
+
+def endpoint_for(url):
+    """Returns the name of the endpoint url belongs to (e.g. 'personas'), or 'other'"""
+    for name, pattern in ENDPOINTS:
+        if pattern.search(url):
+            return name
+    return 'other'
+
+
+class Histogram(object):
+    """Counts of observations falling in each of BUCKETS, plus their total"""
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0]*(len(buckets) + 1)  # The last one is for observations beyond the largest bucket
+        self.count = 0
+        self.sum = 0.
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q):
+        """An estimate of the q quantile: the upper bound of the bucket it falls in"""
+        if not self.count:
+            return None
+        rank = q*self.count
+        seen = 0
+        for bound, n in zip(self.buckets, self.counts):
+            seen += n
+            if seen >= rank:
+                return bound
+        return float('inf')
+
+    def to_dict(self):
+        return {
+            'count': self.count,
+            'sum': self.sum,
+            'mean': self.sum/self.count if self.count else None,
+            'p50': self.quantile(0.5),
+            'p99': self.quantile(0.99),
+        }
+
+
+def _key(name, labels):
+    return name, tuple(sorted(labels.items()))
+
+
+def _format(name, labels):
+    if not labels:
+        return name
+    return '{}{{{}}}'.format(name, ','.join('{}="{}"'.format(k, v) for k, v in labels))
+
+
+class Metrics(object):
+    """A registry of counters, gauges and histograms, each identified by a name and labels. Safe to share between
+    threads.
+
+    The counters records_total and pids_done_total, and the gauge pids_expected, give the progress of a run.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+        self.started = time.time()
+
+    def inc(self, name, value=1, **labels):
+        """Adds value to a counter"""
+        key = _key(name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        """Sets a gauge"""
+        with self.lock:
+            self.gauges[_key(name, labels)] = value
+
+    def observe(self, name, value, **labels):
+        """Adds an observation (e.g. seconds a request took) to a histogram"""
+        key = _key(name, labels)
+        with self.lock:
+            if key not in self.histograms:
+                self.histograms[key] = Histogram()
+            self.histograms[key].observe(value)
+
+    @contextmanager
+    def timer(self, stage):
+        """Times the code in a with block as part of stage, in the stage_seconds histogram"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe('stage_seconds', time.perf_counter() - start, stage=stage)
+
+    def value(self, name, **labels):
+        """Returns the value of a counter or gauge (0 if it hasn't been set)"""
+        key = _key(name, labels)
+        with self.lock:
+            return self.counters.get(key, self.gauges.get(key, 0))
+
+    def total(self, name):
+        """Returns the sum of a counter over all its labels"""
+        with self.lock:
+            return sum(v for (n, _), v in self.counters.items() if n == name)
+
+    def snapshot(self):
+        """Returns everything recorded so far as a dict that can be dumped to JSON"""
+        with self.lock:
+            return {
+                'time': time.time(),
+                'elapsed': time.time() - self.started,
+                'counters': {_format(*k): v for k, v in self.counters.items()},
+                'gauges': {_format(*k): v for k, v in self.gauges.items()},
+                'histograms': {_format(*k): h.to_dict() for k, h in self.histograms.items()},
+            }
+
+    def to_prometheus(self):
+        """Returns everything recorded so far in the Prometheus text exposition format"""
+        lines = []
+        with self.lock:
+            for kind, metrics in (('counter', self.counters), ('gauge', self.gauges)):
+                for name in sorted({n for n, _ in metrics}):
+                    lines.append(f'# TYPE {PREFIX}{name} {kind}')
+                    for (n, labels), v in sorted(metrics.items()):
+                        if n == name:
+                            lines.append('{} {}'.format(_format(PREFIX + name, labels), v))
+            for name in sorted({n for n, _ in self.histograms}):
+                lines.append(f'# TYPE {PREFIX}{name} histogram')
+                for (n, labels), h in sorted(self.histograms.items(), key=lambda x: x[0]):
+                    if n != name:
+                        continue
+                    seen = 0
+                    for bound, count in zip(h.buckets + (float('inf'),), h.counts):
+                        seen += count
+                        le = '+Inf' if bound == float('inf') else repr(bound)
+                        lines.append('{} {}'.format(_format(PREFIX + name + '_bucket', labels + (('le', le),)), seen))
+                    lines.append('{} {}'.format(_format(PREFIX + name + '_sum', labels), h.sum))
+                    lines.append('{} {}'.format(_format(PREFIX + name + '_count', labels), h.count))
+        return '\n'.join(lines) + '\n'
+
+    def reset(self):
+        with self.lock:
+            self.counters = {}
+            self.gauges = {}
+            self.histograms = {}
+            self.started = time.time()
+
+
+class Exporter(object):
+    """Writes snapshots of a Metrics registry to a file every interval seconds from a background thread,
+    and prints the progress of the run (PIDs done, records per second and the estimated time left).
+    The file is replaced atomically, so it can be watched (or scraped by node_exporter's textfile collector).
+
+    path (str, optional): the file to write. Written in the Prometheus text format if it ends with .prom,
+        otherwise as JSON. If None, only the progress is printed.
+    interval (float): seconds between snapshots
+    registry (Metrics, optional): defaults to the shared registry
+    readout (bool): whether to print the progress with each snapshot
+    """
+
+    def __init__(self, path=None, interval=INTERVAL, registry=None, readout=True):
+        self.path = path
+        self.interval = interval
+        self.registry = registry if registry is not None else get_metrics()
+        self.readout = readout
+        self.stopped = threading.Event()
+        self.thread = None
+        self.last = None  # (time, records) at the last snapshot
+
+    def progress(self):
+        """Returns a dict with the PIDs done and expected, records per second (since the last snapshot), and the
+        estimated seconds left (from the average rate so far)
+        """
+        now = time.time()
+        done = self.registry.total('pids_done_total')
+        expected = self.registry.value('pids_expected') or None
+        records = self.registry.total('records_total')
+        elapsed = now - self.registry.started
+        if self.last is not None and now > self.last[0]:
+            records_per_second = (records - self.last[1])/(now - self.last[0])
+        else:
+            records_per_second = records/elapsed if elapsed > 0 else 0.
+        self.last = (now, records)
+        eta = None
+        if expected is not None and done:
+            eta = max(expected - done, 0)*elapsed/done
+        return {'pids_done': done, 'pids_expected': expected, 'records': records,
+                'records_per_second': records_per_second, 'eta_seconds': eta}
+
+    def export(self):
+        """Writes a snapshot (and prints the progress) now"""
+        progress = self.progress()
+        if self.path is not None:
+            if self.path.endswith('.prom'):
+                text = self.registry.to_prometheus()
+            else:
+                snapshot = self.registry.snapshot()
+                snapshot['progress'] = progress
+                text = json.dumps(snapshot, indent=1)
+            temp = self.path + '.tmp'
+            with open(temp, 'w') as fh:
+                fh.write(text)
+            os.replace(temp, self.path)
+        if self.readout:
+            done = progress['pids_done']
+            of = f"/{progress['pids_expected']}" if progress['pids_expected'] else ''
+            eta = progress['eta_seconds']
+            eta = time.strftime('%H:%M:%S', time.gmtime(eta)) if eta is not None else '?'
+            print(f"{done}{of} PIDs done, {progress['records_per_second']:.1f} records/s, ETA {eta}")
+        return progress
+
+    def _run(self):
+        while not self.stopped.wait(self.interval):
+            self.export()
+
+    def start(self):
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        """Stops the background thread and writes a final snapshot"""
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+        self.export()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+
+_metrics = Metrics()
+
+
+def get_metrics():
+    """Returns the shared Metrics registry"""
+    return _metrics
+
+
+def inc(name, value=1, **labels):
+    _metrics.inc(name, value, **labels)
+
+
+def observe(name, value, **labels):
+    _metrics.observe(name, value, **labels)
+
+
+def timer(stage):
+    return _metrics.timer(stage)
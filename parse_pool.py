@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+"""
+Process pool for parsing records, so that parsing isn't held back by the GIL while many requests are in flight.
+
+Threads waiting on the network hand the raw bytes of each persona response to a ParsePool, which groups them into
+batches and sends each batch to a worker process for JSON decoding and extraction (get_sources.parse_record).
+The parsed records come back as plain lists and dicts.
+"""
+
+import json
+import os
+import threading
+import time
+from concurrent.futures import Future, ProcessPoolExecutor
+
+
+# Default number of responses sent to a worker process at once
+BATCH_SIZE = 16
+# Seconds a partial batch waits for more responses before it is sent anyway
+FLUSH_INTERVAL = 0.01
+
+
+def parse_batch(items):
+    """Parses a batch of (content, arkid) pairs of raw persona responses. Runs in the worker processes."""
+    import get_sources
+    return [get_sources.parse_record(json.loads(content), arkid) for content, arkid in items]
+
+
+class ParsePool(object):
+    """Parses raw persona responses in a pool of processes. submit() can be called from many threads at once.
+
+    processes (int, optional): the number of worker processes. Defaults to the number of CPUs.
+    batch_size (int): the number of responses to send to a worker process at once
+    flush_interval (float): seconds a partial batch waits for more responses before being sent anyway
+    """
+
+    def __init__(self, processes=None, batch_size=BATCH_SIZE, flush_interval=FLUSH_INTERVAL):
+        self.processes = processes or os.cpu_count()
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.executor = ProcessPoolExecutor(max_workers=self.processes)
+        self.pending = []
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.closed = False
+        self.flusher = threading.Thread(target=self._flush_periodically, daemon=True)
+        self.flusher.start()
+
+    def submit(self, content, arkid):
+        """Queues the raw content of a persona response for parsing.
+        Returns a Future for the record (as from get_sources.parse_record).
+        """
+        future = Future()
+        with self.lock:
+            if self.closed:
+                raise RuntimeError('ParsePool is closed')
+            self.pending.append((content, arkid, future))
+            if len(self.pending) >= self.batch_size:
+                self._dispatch()
+            else:
+                self.wakeup.set()
+        return future
+
+    def parse(self, content, arkid):
+        """Parses the raw content of a persona response in the pool and waits for the result"""
+        return self.submit(content, arkid).result()
+
+    def _dispatch(self):
+        """Sends the pending responses to a worker process. Must be called with self.lock held."""
+        if not self.pending:
+            return
+        batch, self.pending = self.pending, []
+        futures = [f for _, _, f in batch]
+        result = self.executor.submit(parse_batch, [(content, arkid) for content, arkid, _ in batch])
+
+        def done(result):
+            try:
+                records = result.result()
+            except BaseException as e:
+                for f in futures:
+                    f.set_exception(e)
+                return
+            for f, record in zip(futures, records):
+                f.set_result(record)
+
+        result.add_done_callback(done)
+
+    def _flush_periodically(self):
+        while not self.closed:
+            self.wakeup.wait()
+            self.wakeup.clear()
+            time.sleep(self.flush_interval)
+            with self.lock:
+                self._dispatch()
+
+    def close(self):
+        """Parses whatever is still pending, then shuts down the worker processes"""
+        with self.lock:
+            self._dispatch()
+            self.closed = True
+            self.wakeup.set()
+        self.executor.shutdown(wait=True)
@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+"""
+Run-wide index of the records fetched from the personas endpoint.
+
+A census record fetched for one person includes everyone else in their household, each with their own ark ID.
+When several members of a household are in the same run, the record fetched for the first of them can be reused for
+the rest instead of requesting the same household again. Requests for an ark ID that is already being fetched by
+another thread wait for that fetch rather than sending their own. Only records that were fetched are kept: if a
+fetch fails, the next request for the ark ID tries again.
+"""
+
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+
+
+# Default maximum number of ark IDs to keep in the index
+MAX_ARKIDS = 200000
+# Ark IDs to keep per PID of a chunk when streaming a run with bounded memory (see for_chunksize). A PID's records
+# each list everyone in its household, so this allows for several records of a large household.
+ARKIDS_PER_PID = 50
+
+
+def for_chunksize(chunksize):
+    """The most ark IDs to keep in the index of a run streamed chunksize PIDs at a time, so that the memory it uses
+    grows with the chunk size rather than with the run (up to MAX_ARKIDS)
+    """
+    return min(MAX_ARKIDS, ARKIDS_PER_PID*chunksize)
+
+
+class PersonaIndex(object):
+    """Maps ark IDs to the records (as from get_sources.parse_record) they appear on. Safe to share between threads.
+
+    max_arkids (int): the number of ark IDs to remember, beyond which the oldest are forgotten
+    """
+
+    def __init__(self, max_arkids=MAX_ARKIDS):
+        self.max_arkids = max_arkids
+        self.records = OrderedDict()  # ark ID -> (record, row of the person on the record)
+        self.in_flight = {}  # ark ID -> Future for a fetch in progress
+        self.lock = threading.Lock()
+        self.fetches = 0
+        self.reused = 0
+
+    @staticmethod
+    def view(record, row):
+        """The record as it would be if fetched for the person on row: the same apart from is_person"""
+        if record is None or row is None:
+            return record
+        fields, is_person, arkids = record
+        if is_person[row] == 1:
+            return record
+        return fields, [int(i == row) for i in range(len(is_person))], arkids
+
+    def _add(self, arkid, record):
+        if record is None:
+            return  # Not available (or the fetch failed), so it is fetched again next time it is asked for
+        arkids = record[2]
+        if arkid in arkids:
+            for row, other in enumerate(arkids):
+                if other is not None and other not in self.records:
+                    self.records[other] = (record, row)
+        # Make sure the ark ID that was asked for maps to the record exactly as it was fetched
+        self.records[arkid] = (record, None)
+        while len(self.records) > self.max_arkids:
+            self.records.popitem(last=False)
+
+    def get(self, arkid, fetch):
+        """Returns the record for arkid, calling fetch(arkid) only if arkid isn't already in the index or being
+        fetched by another thread (in which case the result of that fetch is returned, even if it failed)
+        """
+        with self.lock:
+            if arkid in self.records:
+                self.reused += 1
+                return self.view(*self.records[arkid])
+            future = self.in_flight.get(arkid)
+            owner = future is None
+            if owner:
+                future = Future()
+                self.in_flight[arkid] = future
+                self.fetches += 1
+            else:
+                self.reused += 1
+        if not owner:
+            return future.result()
+        try:
+            record = fetch(arkid)
+        except BaseException as e:
+            with self.lock:
+                del self.in_flight[arkid]
+            future.set_exception(e)
+            raise
+        with self.lock:
+            self._add(arkid, record)
+            del self.in_flight[arkid]
+        future.set_result(record)
+        return record
@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+"""
+Finding PIDs and getting their records in a single run, with the two overlapping.
+
+Normally find.py matches people to PIDs and writes them to a CSV, and only then are the records for the PIDs in
+that CSV fetched. find_and_save_records instead feeds each PID straight from the matching stage to the records
+stage as soon as it is found (if its best match scores at least min_score):
+
+    match queries (find_workers threads) -> bounded queue of PIDs -> records (the sourcer's workers) -> saveas
+
+Each stage has its own concurrency. The queue between them holds at most queue_size PIDs: if fetching records falls
+behind, matching waits for room rather than racing ahead, and if matching falls behind, the records stage waits for
+PIDs. Records are saved chunk by chunk as with get_sources.stream_records_for_pids.
+"""
+
+import queue
+import threading
+
+import find
+import get_sources
+import metrics
+
+
+# Default most PIDs waiting between the stages
+QUEUE_SIZE = 100
+# Marks the end of the PIDs in the queue
+DONE = object()
+
+
+class _Stopped(Exception):
+    """Raised in the matching stage when the records stage has stopped"""
+
+
+def find_and_save_records(df, lookfor, saveas, condense=None, min_score=None, find_workers=4, workers=4,
+                          queue_size=QUEUE_SIZE, chunksize=1000, save_uncondensed=True, index_col=0,
+                          columndict=find.COLUMN_MAP, response_cache=None, key_pool=None, verbose=True, output=None,
+                          **sourcer_kwargs):
+    """Matches the rows of df to PIDs (as find.FamilySearchFind.get_fsids_for_df) and gets and saves the records
+    of the PIDs (as get_sources.stream_records_for_pids) at the same time.
+    Returns the matches for df, as from get_fsids_for_df.
+
+    df (DataFrame or str): the people to match (or the file name of a CSV of them), with a column for each piece of
+        identifying info
+    lookfor (str): the regex pattern used to identify record types from their descriptions
+    saveas (str): the file name to save the (condensed, if condense is provided) records to
+    condense (function, optional): the function to use to condense each chunk of records (e.g. condense_census)
+    min_score (float, optional): the lowest score of a best match (score1) to get the records of. Defaults to
+        getting the records of every best match.
+    find_workers (int): the number of threads to send match queries from
+    workers (int): the number of requests for records to keep in flight at once
+    queue_size (int): the most matched PIDs to hold between the stages
+    chunksize (int): the number of PIDs per chunk of records saved
+    save_uncondensed (bool): if condense is provided, whether to also save the uncondensed records
+    index_col, columndict: as for get_fsids_for_df
+    response_cache (cache.ResponseCache, optional): a cache to read API responses through (in both stages)
+    key_pool (authenticate.KeyPool, optional): auth keys to spread the match queries over
+    verbose (bool): whether to print updates for each row as it is matched
+    output (columnar.ColumnarOutput, optional): if provided, save the records to Parquet/Arrow datasets
+    Any other keyword arguments are passed on to get_sources.FamilySearchSourcer.
+    """
+    fsf = find.FamilySearchFind(response_cache=response_cache, key_pool=key_pool)
+    df = fsf.prepare_df(df, index_col, columndict)
+    distinct, codes = fsf.distinct_queries(df)
+    results = [None]*len(distinct)
+    pids = queue.Queue(maxsize=queue_size)
+    stopped = threading.Event()
+    errors = []
+
+    def put(item):
+        while True:
+            if stopped.is_set():
+                raise _Stopped()
+            try:
+                pids.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+    def match(position):
+        if verbose:
+            print(f'Matching {distinct.index[position]}...')
+        result = fsf.get_fsid_for_query(distinct.iloc[position])
+        results[position] = result
+        metrics.inc('rows_matched_total')
+        if 'pid1' in result and (min_score is None or result['score1'] >= min_score):
+            put(result['pid1'])
+            metrics.get_metrics().set('pipeline_queued_pids', pids.qsize())
+
+    def match_all():
+        try:
+            fsf.run_threaded(match, len(distinct), find_workers)
+        except _Stopped:
+            return
+        except BaseException as e:
+            errors.append(e)
+        try:
+            put(DONE)
+        except _Stopped:
+            pass
+
+    def matched_pids():
+        while True:
+            pid = pids.get()
+            if pid is DONE:
+                return
+            metrics.get_metrics().set('pipeline_queued_pids', pids.qsize())
+            yield pid
+
+    matcher = threading.Thread(target=match_all, daemon=True)
+    matcher.start()
+    try:
+        get_sources.stream_records_for_pids(lookfor, matched_pids(), saveas, condense, chunksize, save_uncondensed,
+                                            workers=workers, response_cache=response_cache, output=output,
+                                            **sourcer_kwargs)
+    finally:
+        stopped.set()
+        matcher.join()
+    if errors:
+        raise errors[0]
+    return fsf.spread_results(results, codes, df.index)
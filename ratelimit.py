@@ -0,0 +1,194 @@
+# -*- coding: utf-8 -*-
+"""
+Rate limiting for requests to the FamilySearch API.
+
+Every request sent through the session module first takes a token from a bucket belonging to the auth key it uses.
+A 429 response pauses requests for as long as the server's Retry-After header asks (all requests by default, or
+just the ones using the same key), and also lowers the rate for that key. The rate then creeps back up, but only to
+just under the rate the server last throttled at, so a long run settles at a pace the server accepts instead of
+repeatedly running into throttling.
+All of this is safe to use from many threads at once.
+"""
+
+import threading
+import time
+from email.utils import parsedate_to_datetime
+
+import metrics
+
+
+# Default requests per second allowed for each auth key
+RATE = 10.
+# Default number of requests that can be sent at once after a quiet period
+BURST = 10
+# The rate will never be lowered below this
+MIN_RATE = 0.2
+# How much to multiply the rate by when throttled
+BACKOFF = 0.5
+# How much the rate (in requests per second) goes back up by after each successful request
+RECOVERY = 0.01
+# How far below the last throttled rate the rate may recover to
+CEILING_MARGIN = 0.9
+# Seconds to pause for if a 429 response has no usable Retry-After header
+DEFAULT_RETRY_AFTER = 60.
+# Pad the server's Retry-After by this factor
+RETRY_AFTER_PADDING = 1.1
+
+
+def parse_retry_after(value, default=DEFAULT_RETRY_AFTER):
+    """Converts the value of a Retry-After header (either a number of seconds or an HTTP date) to seconds"""
+    if value is None:
+        return default
+    try:
+        return max(float(value), 0.)
+    except ValueError:
+        pass
+    try:
+        return max(parsedate_to_datetime(value).timestamp() - time.time(), 0.)
+    except (TypeError, ValueError):
+        return default
+
+
+class TokenBucket(object):
+    """A token bucket that refills at self.rate tokens per second, up to self.burst tokens"""
+
+    def __init__(self, rate=RATE, burst=BURST):
+        self.max_rate = rate
+        self.rate = rate
+        self.ceiling = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.last = time.monotonic()
+        self.paused_until = 0.
+        self.lock = threading.Lock()
+
+    def _refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.last)*self.rate)
+        self.last = now
+
+    def reserve(self):
+        """Takes a token and returns how many seconds the caller must wait before using it.
+        The bucket is allowed to go into debt, so that concurrent callers are spaced out rather than all waking at once.
+        """
+        with self.lock:
+            now = time.monotonic()
+            self._refill(now)
+            self.tokens -= 1
+            if self.tokens >= 0:
+                return 0.
+            return -self.tokens/self.rate
+
+    def slow_down(self, backoff=BACKOFF, min_rate=MIN_RATE):
+        with self.lock:
+            self._refill(time.monotonic())
+            self.ceiling = max(min_rate, self.rate*CEILING_MARGIN)
+            self.rate = max(min_rate, self.rate*backoff)
+
+    def speed_up(self, recovery=RECOVERY):
+        with self.lock:
+            if self.rate < self.ceiling:
+                self._refill(time.monotonic())
+                self.rate = min(self.ceiling, self.rate + recovery)
+
+
+class RateLimiter(object):
+    """Keeps a TokenBucket for each auth key, and a global pause shared by all of them.
+
+    rate (float): the starting (and maximum) requests per second for each key
+    burst (int): how many requests a key can send at once after being idle
+    min_rate (float): the lowest the rate of a key will be lowered to after being throttled
+    backoff (float): the factor the rate of a key is multiplied by each time it is throttled
+    recovery (float): how much the rate of a key goes back up by after each successful request
+    pause_scope (str): 'global' to pause requests with every key when any key is throttled, or 'key' to only pause
+        the key that was throttled (for when requests are spread over several keys, e.g. with authenticate.KeyPool)
+    """
+
+    def __init__(self, rate=RATE, burst=BURST, min_rate=MIN_RATE, backoff=BACKOFF, recovery=RECOVERY,
+                 pause_scope='global'):
+        if pause_scope not in ('global', 'key'):
+            raise ValueError(f"pause_scope must be 'global' or 'key', not {pause_scope!r}")
+        self.pause_scope = pause_scope
+        self.rate = rate
+        self.burst = burst
+        self.min_rate = min_rate
+        self.backoff = backoff
+        self.recovery = recovery
+        self.buckets = {}
+        self.paused_until = 0.
+        self.lock = threading.Lock()
+        # The number of 429 responses, and the seconds spent waiting in acquire (summed over all threads)
+        self.throttles = 0
+        self.wait_time = 0.
+
+    def bucket(self, key):
+        with self.lock:
+            if key not in self.buckets:
+                self.buckets[key] = TokenBucket(self.rate, self.burst)
+            return self.buckets[key]
+
+    def paused_for(self, key=None):
+        """Returns how many more seconds requests with key are paused for (0 if they aren't)"""
+        paused_until = max(self.paused_until, self.bucket(key).paused_until)
+        return max(paused_until - time.monotonic(), 0.)
+
+    def _sleep(self, seconds, reason):
+        time.sleep(seconds)
+        with self.lock:
+            self.wait_time += seconds
+        metrics.inc('ratelimit_wait_seconds', seconds, reason=reason)
+
+    def wait_for_pause(self, key=None):
+        """Blocks until any pause set by throttled() that applies to key is over"""
+        while True:
+            wait = self.paused_for(key)
+            if wait <= 0:
+                return
+            self._sleep(wait, 'retry_after')
+
+    def acquire(self, key=None):
+        """Blocks until a request may be sent with the auth key key"""
+        self.wait_for_pause(key)
+        wait = self.bucket(key).reserve()
+        if wait > 0:
+            self._sleep(wait, 'rate')
+        # A pause may have started while we were waiting for our turn
+        self.wait_for_pause(key)
+
+    def throttled(self, key, retry_after=None, scope=None):
+        """Records a 429 response for key. Pauses requests (see pause_scope) and lowers the rate for key.
+
+        retry_after (str, optional): the value of the response's Retry-After header
+        scope (str, optional): 'global' or 'key', overriding pause_scope for this response (e.g. 'key' for a request
+            that will be retried with another key from a pool)
+        Returns the number of seconds requests are paused for.
+        """
+        wait = parse_retry_after(retry_after)*RETRY_AFTER_PADDING
+        bucket = self.bucket(key)
+        with self.lock:
+            self.throttles += 1
+            until = time.monotonic() + wait
+            bucket.paused_until = max(bucket.paused_until, until)
+            if (scope or self.pause_scope) == 'global':
+                self.paused_until = max(self.paused_until, until)
+        bucket.slow_down(self.backoff, self.min_rate)
+        metrics.inc('throttled_total')
+        metrics.inc('retry_after_seconds', wait)
+        return wait
+
+    def succeeded(self, key=None):
+        """Records a response for key that was not throttled"""
+        self.bucket(key).speed_up(self.recovery)
+
+
+_limiter = RateLimiter()
+
+
+def configure(**kwargs):
+    """Replaces the shared RateLimiter with a new one. Takes the same arguments as RateLimiter"""
+    global _limiter
+    _limiter = RateLimiter(**kwargs)
+
+
+def get_limiter():
+    """Returns the shared RateLimiter used by the session module"""
+    return _limiter
@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+"""
+Incremental refresh of a dataset of records, for re-running a pull whose PIDs have mostly not changed.
+
+For each PID, a RefreshState keeps the validators (ETag and Last-Modified) of its attached sources list and the ark
+IDs of the attached records matching the pattern looked for, as of the last refresh. A refresh sends a conditional
+request for each PID's sources. If the API answers 304 Not Modified, or the attached ark IDs are the same as last
+time, the PID is unchanged and nothing else is requested for it (no searching for unattached records, and no
+record fetches). The records of the changed and new PIDs are fetched in full, saved as a delta, and merged into the
+previous output in place of those PIDs' old rows.
+
+    refresh_records_for_pids_in_csv(get_sources.CENSUS_PTTRN, 'pids.csv', 'census.csv', get_sources.condense_census)
+
+The first refresh of a dataset (with no state yet) fetches everything, like an ordinary run.
+"""
+
+import json
+import os
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pandas as pd
+
+import get_sources
+import metrics
+import retry
+
+
+class RefreshState(object):
+    """What the attached sources of each PID looked like when it was last refreshed, kept in SQLite.
+    Safe to share between threads.
+
+    path (str): the file to keep the state in
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        with self.lock, self.conn:
+            self.conn.execute(
+                'CREATE TABLE IF NOT EXISTS pids ('
+                'pid TEXT, lookfor TEXT, etag TEXT, last_modified TEXT, arkids TEXT, refreshed_at REAL, '
+                'PRIMARY KEY (pid, lookfor))'
+            )
+
+    def get(self, pid, lookfor):
+        """Returns (etag, last_modified, arkids) for pid as of its last refresh looking for lookfor, or None if it
+        hasn't been refreshed
+        """
+        with self.lock:
+            row = self.conn.execute('SELECT etag, last_modified, arkids FROM pids WHERE pid=? AND lookfor=?',
+                                    (str(pid), lookfor)).fetchone()
+        if row is None:
+            return None
+        etag, last_modified, arkids = row
+        return etag, last_modified, json.loads(arkids)
+
+    def put_many(self, rows):
+        """Stores rows of (pid, lookfor, etag, last_modified, arkids)"""
+        now = time.time()
+        with self.lock, self.conn:
+            self.conn.executemany('INSERT OR REPLACE INTO pids VALUES (?, ?, ?, ?, ?, ?)',
+                                  [(str(pid), lookfor, etag, last_modified, json.dumps(arkids), now)
+                                   for pid, lookfor, etag, last_modified, arkids in rows])
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def state_for(saveas):
+    """The RefreshState file used when refreshing the output saved at saveas"""
+    return saveas + '.refresh.sqlite'
+
+
+def delta_name(saveas):
+    """The file name the rows that changed in a refresh of saveas are saved at"""
+    root, ext = os.path.splitext(saveas)
+    return root + '_delta' + ext
+
+
+def check_pid(fss, state, pid, lookfor):
+    """Checks whether the attached sources of pid have changed since its last refresh.
+    Returns (changed, new_state, sources): whether they have, the (pid, lookfor, etag, last_modified, arkids) to
+    store for it, and the sources list fetched. new_state and sources are None if the API answered 304 Not Modified
+    or the request failed, in which case the PID counts as unchanged, so that its rows and stored state are kept.
+    """
+    previous = state.get(pid, lookfor)
+    etag, last_modified, arkids = previous if previous is not None else (None, None, None)
+    while True:
+        try:
+            sources, etag, last_modified = fss.get_attached_sources_if_changed(pid, etag, last_modified)
+            break
+        except retry.CircuitOpen as e:
+            fss.defer_pid(pid, e)
+    if sources is None:
+        return False, None, None
+    new_arkids = sorted(set(fss.attached_arkids(sources, lookfor)))
+    return previous is None or new_arkids != arkids, (pid, lookfor, etag, last_modified, new_arkids), sources
+
+
+def merge_delta(delta, changed, saveas):
+    """Replaces the rows of the changed PIDs in the CSV at saveas (if there is one) with the rows in delta.
+    The rows of the other PIDs are copied as they are (read as text, so that their values aren't reformatted), and
+    if no PIDs have changed, saveas is left alone.
+    """
+    if not changed:
+        return
+    if os.path.isfile(saveas):
+        previous = pd.read_csv(saveas, dtype=str, keep_default_na=False)
+        kept = previous[~previous['PID'].isin([str(pid) for pid in changed])]
+        delta = pd.concat([kept, delta], sort=False)
+    tmp = saveas + '.tmp'
+    delta.to_csv(tmp, index=False)
+    os.replace(tmp, saveas)
+
+
+def refresh_records_for_pids_in_csv(lookfor, filename, saveas, condense=None, col_name='PID',
+                                    save_uncondensed=True, workers=1, response_cache=None, state_path=None,
+                                    **sourcer_kwargs):
+    """Brings the output of an earlier run (see get_sources.get_and_save_records_for_pids_in_csv) up to date,
+    only fetching the records of the PIDs whose attached sources have changed (or that are new).
+    The changed rows are saved at delta_name(saveas), and merged into saveas (and the uncondensed data, if
+    save_uncondensed). Returns the delta.
+
+    lookfor (str): the regex pattern used to identify record types from their descriptions
+    filename (str): the file name of the CSV to get the PIDs from
+    saveas (str): the CSV the output of the earlier run was saved at
+    condense (function, optional): the function the output was condensed with (e.g. condense_census)
+    col_name (str): the name of the column that contains the PIDs
+    save_uncondensed (bool): if condense is provided, whether to also update the uncondensed data
+    workers (int): the number of requests to keep in flight at once
+    response_cache (cache.ResponseCache, optional): a cache to read API responses through. The sources lists are
+        always requested from the API, and stored in the cache if they have changed.
+    state_path (str, optional): the RefreshState file. Defaults to state_for(saveas).
+    Any other keyword arguments are passed on to get_sources.FamilySearchSourcer.
+    """
+    pids = list(pd.read_csv(filename, usecols=[col_name])[col_name].drop_duplicates())
+    with RefreshState(state_path or state_for(saveas)) as state:
+        with get_sources.FamilySearchSourcer(workers=workers, response_cache=response_cache,
+                                             **sourcer_kwargs) as fss:
+            with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+                checks = list(executor.map(lambda pid: check_pid(fss, state, pid, lookfor), pids))
+            changed = [pid for pid, (is_changed, _, _) in zip(pids, checks) if is_changed]
+            # The sources of the changed PIDs were just fetched, so don't request them again for their records
+            fss.known_sources.update((pid, sources) for pid, (is_changed, _, sources) in zip(pids, checks)
+                                     if is_changed)
+            metrics.inc('pids_unchanged_total', len(pids) - len(changed))
+            print(f'{len(changed)} of {len(pids)} PIDs have changed')
+            metrics.get_metrics().set('pids_expected', len(changed))
+            delta = fss.get_records_for_pids(changed, lookfor).reset_index(drop=True)
+        if condense is not None:
+            if save_uncondensed:
+                merge_delta(delta, changed, get_sources.uncondensed_name(saveas))
+            delta = condense(delta)
+        delta.to_csv(delta_name(saveas), index=False)
+        merge_delta(delta, changed, saveas)
+        # Only once the output is saved, so that a refresh that fails part way is redone in full next time
+        state.put_many(new_state for _, new_state, _ in checks if new_state is not None)
+    return delta
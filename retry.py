@@ -0,0 +1,253 @@
+# -*- coding: utf-8 -*-
+"""
+Retrying of requests that fail on the server side (5xx responses, or the connection failing).
+
+Each request gets its own retry state (see RetryPolicy.start), so concurrent requests don't share a retry count.
+Retries back off exponentially with full jitter (a random wait of up to BASE_DELAY * 2**attempt, capped at
+MAX_DELAY), and stop after MAX_ATTEMPTS attempts or once DEADLINE seconds have passed since the first one.
+
+Each endpoint also has a CircuitBreaker. After FAILURE_THRESHOLD failures in a row it opens, and requests to that
+endpoint stop being sent. Once RESET_TIMEOUT seconds have passed, a single request is let through as a probe: if it
+succeeds the breaker closes again, and if not it stays open for another RESET_TIMEOUT. While a breaker is open,
+call() either waits for it, or (with defer=True) raises CircuitOpen straight away so that the caller can get on with
+other work (e.g. PIDs whose requests go to other endpoints) and come back later.
+All of this is safe to use from many threads at once.
+"""
+
+import random
+import threading
+import time
+
+import requests
+
+import metrics
+
+
+# The most times a request is sent (including the first)
+MAX_ATTEMPTS = 4
+# Seconds the backoff starts from, doubling with each retry
+BASE_DELAY = 1.
+# The longest to wait before a retry
+MAX_DELAY = 60.
+# Seconds after the first attempt beyond which a request isn't retried
+DEADLINE = 300.
+# Failures in a row that open an endpoint's circuit breaker
+FAILURE_THRESHOLD = 5
+# Seconds an open circuit breaker waits before letting a probe request through
+RESET_TIMEOUT = 30.
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+
+def is_server_error(response):
+    return response.status_code >= 500
+
+
+class CircuitOpen(Exception):
+    """Raised instead of sending a request to an endpoint whose circuit breaker is open
+
+    retry_in (float): seconds until the breaker lets a request through again
+    """
+
+    def __init__(self, endpoint, retry_in):
+        super().__init__(f'Circuit breaker for {endpoint} is open (retry in {retry_in:.1f} seconds)')
+        self.endpoint = endpoint
+        self.retry_in = retry_in
+
+
+class RetryState(object):
+    """The retries of a single request (see RetryPolicy.start)"""
+
+    def __init__(self, policy):
+        self.policy = policy
+        self.attempts = 0
+        self.deadline = time.monotonic() + policy.deadline
+
+    def next_wait(self):
+        """Counts a failed attempt. Returns the seconds to wait before trying again, or None to give up."""
+        self.attempts += 1
+        if self.attempts >= self.policy.max_attempts:
+            return None
+        wait = self.policy.backoff(self.attempts - 1)
+        if time.monotonic() + wait > self.deadline:
+            return None
+        return wait
+
+
+class RetryPolicy(object):
+    """How often and how long to retry failed requests for
+
+    max_attempts (int): the most times a request is sent (including the first)
+    base_delay (float): seconds the backoff starts from, doubling with each retry
+    max_delay (float): the longest to wait before a retry
+    deadline (float): seconds after the first attempt beyond which a request isn't retried
+    """
+
+    def __init__(self, max_attempts=MAX_ATTEMPTS, base_delay=BASE_DELAY, max_delay=MAX_DELAY, deadline=DEADLINE):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.deadline = deadline
+
+    def backoff(self, retry):
+        """Seconds to wait before retry number retry (from 0), with full jitter"""
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2**retry))
+
+    def start(self):
+        """Returns a new RetryState for a request"""
+        return RetryState(self)
+
+
+class CircuitBreaker(object):
+    """Stops requests to an endpoint that keeps failing, probing it now and then until it recovers
+
+    endpoint (str): the name of the endpoint (for metrics and messages)
+    failure_threshold (int): failures in a row that open the breaker
+    reset_timeout (float): seconds the breaker stays open before letting a probe request through
+    """
+
+    def __init__(self, endpoint, failure_threshold=FAILURE_THRESHOLD, reset_timeout=RESET_TIMEOUT):
+        self.endpoint = endpoint
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = 0.
+        self.lock = threading.Lock()
+
+    def allow(self):
+        """Whether a request may be sent now. When the breaker is ready to probe, only the first caller is allowed."""
+        with self.lock:
+            if self.state == CLOSED:
+                return True
+            if self.state == OPEN and time.monotonic() - self.opened_at >= self.reset_timeout:
+                self.state = HALF_OPEN
+                return True
+            return False
+
+    def is_open(self):
+        return self.state != CLOSED
+
+    def retry_in(self):
+        """Seconds until the breaker may let a request through again"""
+        with self.lock:
+            if self.state == CLOSED:
+                return 0.
+            if self.state == HALF_OPEN:
+                # A probe is in flight; check back soon
+                return min(self.reset_timeout, 1.)
+            return max(self.opened_at + self.reset_timeout - time.monotonic(), 0.)
+
+    def succeeded(self):
+        with self.lock:
+            if self.state == OPEN:
+                return  # From a request sent before the breaker opened. Only a probe can close it.
+            self.failures = 0
+            if self.state == HALF_OPEN:
+                print(f'{self.endpoint} has recovered')
+                self.state = CLOSED
+                metrics.get_metrics().set('breaker_open', 0, endpoint=self.endpoint)
+
+    def abandoned(self):
+        """Records that a request was given up on without an outcome (e.g. interrupted). If it was the probe, the
+        next request is let through as the probe instead.
+        """
+        with self.lock:
+            if self.state == HALF_OPEN:
+                self.state = OPEN
+                self.opened_at = time.monotonic() - self.reset_timeout
+
+    def failed(self):
+        with self.lock:
+            self.failures += 1
+            if self.state == HALF_OPEN or (self.state == CLOSED and self.failures >= self.failure_threshold):
+                if self.state == CLOSED:
+                    print(f'{self.endpoint} keeps failing. Pausing requests to it for {self.reset_timeout} seconds.')
+                    metrics.inc('breaker_opened_total', endpoint=self.endpoint)
+                    metrics.get_metrics().set('breaker_open', 1, endpoint=self.endpoint)
+                self.state = OPEN
+                self.opened_at = time.monotonic()
+
+
+_policy = RetryPolicy()
+_breaker_settings = {'failure_threshold': FAILURE_THRESHOLD, 'reset_timeout': RESET_TIMEOUT}
+_breakers = {}
+_lock = threading.Lock()
+
+
+def configure(failure_threshold=FAILURE_THRESHOLD, reset_timeout=RESET_TIMEOUT, **policy_kwargs):
+    """Replaces the shared retry policy (see RetryPolicy for the keyword arguments) and circuit breakers"""
+    global _policy
+    with _lock:
+        _policy = RetryPolicy(**policy_kwargs)
+        _breaker_settings.update(failure_threshold=failure_threshold, reset_timeout=reset_timeout)
+        _breakers.clear()
+
+
+def get_policy():
+    """Returns the shared RetryPolicy"""
+    return _policy
+
+
+def get_breaker(endpoint):
+    """Returns the shared CircuitBreaker for endpoint, creating it if needed"""
+    breaker = _breakers.get(endpoint)
+    if breaker is None:
+        with _lock:
+            breaker = _breakers.setdefault(endpoint, CircuitBreaker(endpoint, **_breaker_settings))
+    return breaker
+
+
+def call(send, endpoint, defer=False, policy=None):
+    """Calls send() (which sends a request and returns the response), retrying it on server errors.
+    Returns the first response that isn't a server error, or the last one if the retries run out.
+    If the connection fails on the last attempt, the exception is raised.
+    With defer, CircuitOpen is also raised if a failure leaves the breaker open, rather than retrying.
+
+    endpoint (str): the endpoint the request is for, whose circuit breaker is used (see metrics.endpoint_for)
+    defer (bool): if the endpoint's circuit breaker is open, whether to raise CircuitOpen instead of waiting for it
+    policy (RetryPolicy, optional): defaults to the shared one (see configure)
+    """
+    breaker = get_breaker(endpoint)
+    state = (policy or _policy).start()
+    while True:
+        while not breaker.allow():
+            wait = breaker.retry_in()
+            if defer:
+                raise CircuitOpen(endpoint, wait)
+            time.sleep(wait)
+        try:
+            response = send()
+        except (requests.ConnectionError, requests.Timeout) as e:
+            breaker.failed()
+            if defer and breaker.is_open():
+                raise CircuitOpen(endpoint, breaker.retry_in()) from e
+            wait = state.next_wait()
+            if wait is None:
+                raise
+            reason, error = 'connection', e
+        except Exception:
+            # Not retried, but still counted, so that a probe that fails this way doesn't leave the breaker half open
+            breaker.failed()
+            raise
+        except BaseException:
+            breaker.abandoned()
+            raise
+        else:
+            if not is_server_error(response):
+                breaker.succeeded()
+                return response
+            breaker.failed()
+            # Once the breaker is open, a deferrable request is put aside rather than retried until it gives up
+            if defer and breaker.is_open():
+                raise CircuitOpen(endpoint, breaker.retry_in())
+            wait = state.next_wait()
+            if wait is None:
+                return response
+            reason, error = '5xx', f'Server-side error ({response.status_code})'
+        print(f'{error}. Retrying in {wait:.1f} seconds...')
+        metrics.inc('retries_total', endpoint=endpoint, reason=reason)
+        metrics.inc('server_error_wait_seconds', wait)
+        time.sleep(wait)
@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+"""
+Journals for resumable batch runs.
+
+A RunJournal is a directory that the rows for completed PIDs are written to as a run goes along, so that if the run
+dies partway through, restarting it picks up where it stopped instead of starting over.
+"""
+
+import hashlib
+import json
+import os
+import shutil
+
+import pandas as pd
+
+
+STATE_FILE = 'state.json'
+
+
+def fingerprint(pids):
+    """A hash identifying a sequence of PIDs, used to make sure a journal is resumed with the same input"""
+    h = hashlib.sha1()
+    for pid in pids:
+        h.update(str(pid).encode('utf-8'))
+        h.update(b'\n')
+    return h.hexdigest()
+
+
+class RunJournal(object):
+    """Keeps track of how many PIDs of a run are done, and the rows they produced.
+
+    PIDs are always completed in input order (see FamilySearchSourcer.iter_parsed_records_for_pids),
+    so the work done is always the first self.done PIDs of the input.
+
+    path (str): the directory to keep the journal in. Created if it doesn't exist.
+    lookfor (str): the record description pattern for the run
+    pids (sequence): all the PIDs for the run, in order
+    """
+
+    def __init__(self, path, lookfor, pids):
+        self.path = path
+        manifest = {'lookfor': lookfor, 'count': len(pids), 'fingerprint': fingerprint(pids)}
+        state_file = os.path.join(path, STATE_FILE)
+        if os.path.isfile(state_file):
+            with open(state_file, 'r') as fh:
+                state = json.load(fh)
+            if state['manifest'] != manifest:
+                raise ValueError(f'Journal at {path} is for a different run; delete it or use another output file')
+            self.done = state['done']
+            self.parts = state['parts']
+            if self.done:
+                print(f'Resuming from journal at {path}: {self.done} of {len(pids)} PIDs already done')
+        else:
+            os.makedirs(path, exist_ok=True)
+            self.done = 0
+            self.parts = []
+        self.manifest = manifest
+
+    def _save_state(self):
+        state_file = os.path.join(self.path, STATE_FILE)
+        tmp = state_file + '.tmp'
+        with open(tmp, 'w') as fh:
+            json.dump({'manifest': self.manifest, 'done': self.done, 'parts': self.parts}, fh)
+            fh.flush()
+            os.fsync(fh.fileno())
+        os.replace(tmp, state_file)
+
+    def record(self, count, df):
+        """Saves the DataFrame with the rows for the next count PIDs of the run and marks those PIDs as done"""
+        if not count:
+            return
+        part = 'part-{:05d}.pkl'.format(len(self.parts))
+        df.to_pickle(os.path.join(self.path, part))
+        # The state only points to the part once it is completely written, so a crash can't leave a partial part
+        self.parts.append(part)
+        self.done += count
+        self._save_state()
+
+    def load(self):
+        """Returns all the rows recorded so far, in input order"""
+        if not self.parts:
+            return pd.DataFrame()
+        return pd.concat(pd.read_pickle(os.path.join(self.path, part)) for part in self.parts)
+
+    def remove(self):
+        """Deletes the journal (e.g. once the run's output has been saved)"""
+        shutil.rmtree(self.path, ignore_errors=True)
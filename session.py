@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+"""
+Shared HTTP session for all requests to FamilySearch.
+
+Every module sends its requests through the one requests.Session kept here, so connections to the API are pooled
+and kept alive between requests instead of paying for a new TCP+TLS handshake each time.
+Requests are also paced by the shared RateLimiter from the ratelimit module, and 429 responses are waited out and
+retried here, so callers never see them. Server errors are retried with backoff, behind a circuit breaker for each
+endpoint (see the retry module).
+"""
+
+import os
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import metrics
+import ratelimit
+import retry
+
+
+# Both can be pointed somewhere else (e.g. at benchmarks/mock_server.py) with environment variables or set_api_root
+API_ROOT = os.environ.get('FAMILYSEARCH_API_ROOT', 'https://api.familysearch.org')
+TOKEN_URL = os.environ.get('FAMILYSEARCH_TOKEN_URL', 'https://ident.familysearch.org/cis-web/oauth2/v3/token')
+# Headers sent with every request unless overridden
+DEFAULT_HEADERS = {'Accept': 'application/json'}
+# Default number of connections kept open per host. Should be at least the number of concurrent workers.
+POOL_SIZE = 10
+
+_session = None
+_pool_size = POOL_SIZE
+_lock = threading.Lock()
+
+
+def _build_session(pool_size):
+    session = requests.Session()
+    session.headers.update(DEFAULT_HEADERS)
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size, pool_block=True)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+def configure(pool_size=POOL_SIZE):
+    """Replaces the shared session with a new one
+
+    pool_size (int): the maximum number of connections to keep open to each host. Requests beyond this many at once
+        wait for a free connection rather than opening (and then discarding) extra ones.
+    """
+    global _session, _pool_size
+    with _lock:
+        old = _session
+        _session = _build_session(pool_size)
+        _pool_size = pool_size
+    if old is not None:
+        old.close()
+
+
+def ensure_pool_size(pool_size):
+    """Makes sure the shared session can hold at least pool_size connections per host (e.g. the number of workers)"""
+    if pool_size > _pool_size:
+        configure(pool_size)
+
+
+def set_api_root(api_root, token_url=None):
+    """Sends requests to the API at api_root (and for access tokens to token_url) instead of FamilySearch
+
+    token_url (str, optional): defaults to the token endpoint under api_root
+    """
+    global API_ROOT, TOKEN_URL
+    API_ROOT = api_root.rstrip('/')
+    TOKEN_URL = token_url if token_url is not None else API_ROOT + '/cis-web/oauth2/v3/token'
+
+
+def get_session():
+    """Returns the shared requests.Session, creating it if needed"""
+    global _session
+    if _session is None:
+        with _lock:
+            if _session is None:
+                _session = _build_session(_pool_size)
+    return _session
+
+
+def auth_headers(key):
+    """The headers needed to authenticate a request with the access token key"""
+    return {'Authorization': 'Bearer {}'.format(key)}
+
+
+def key_of(response):
+    """The access token the request for response was sent with, or None if it had none (or didn't come from the
+    network)
+    """
+    request = getattr(response, 'request', None)
+    authorization = request.headers.get('Authorization', '') if request is not None else ''
+    return authorization[len('Bearer '):] if authorization.startswith('Bearer ') else None
+
+
+def limiter_key(key):
+    """The key the rate limiter knows requests authenticated with the access token key by"""
+    return auth_headers(key)['Authorization']
+
+
+def request(method, url, retry_throttled=True, defer=False, **kwargs):
+    """Sends a request through the shared session once the rate limiter allows it.
+    If the response is a 429 (throttled), waits as long as the server asks and sends the request again,
+    unless retry_throttled is False, in which case the 429 response is returned (e.g. to retry with another key).
+    The pause for a 429 returned that way only applies to the key it was sent with, so that other keys carry on.
+    Server errors are retried (see retry.call). If the circuit breaker for the endpoint of url is open, waits for it,
+    unless defer is True, in which case retry.CircuitOpen is raised.
+    Otherwise takes the same arguments as requests.request
+    """
+    endpoint = metrics.endpoint_for(url)
+    return retry.call(lambda: _send(method, url, endpoint, retry_throttled, **kwargs), endpoint, defer)
+
+
+def _send(method, url, endpoint, retry_throttled, **kwargs):
+    limiter = ratelimit.get_limiter()
+    # Requests are rate limited separately for each auth key
+    key = (kwargs.get('headers') or {}).get('Authorization')
+    while True:
+        limiter.acquire(key)
+        start = time.perf_counter()
+        response = get_session().request(method, url, **kwargs)
+        metrics.observe('request_seconds', time.perf_counter() - start, endpoint=endpoint,
+                        status=response.status_code)
+        if response.status_code != 429:
+            limiter.succeeded(key)
+            return response
+        if not retry_throttled:
+            limiter.throttled(key, response.headers.get('Retry-After'), scope='key')
+            return response
+        wait = limiter.throttled(key, response.headers.get('Retry-After'))
+        metrics.inc('retries_total', endpoint=endpoint, reason='429')
+        print('Throttled, waiting {:.1f} seconds!'.format(wait))
+
+
+def get(url, **kwargs):
+    """Sends a GET request through the shared session. Takes the same arguments as requests.get"""
+    return request('GET', url, **kwargs)
+
+
+def post(url, **kwargs):
+    """Sends a POST request through the shared session. Takes the same arguments as requests.post"""
+    return request('POST', url, **kwargs)